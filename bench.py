@@ -0,0 +1,439 @@
+import _pickle as cpickle
+import argparse
+import asyncio
+import byte_tools as bt
+import concurrent.futures
+import contextlib
+import filter_ops
+import io
+import json
+import msg_codec
+import numpy as np
+import os
+import param_planner
+import platform
+import random
+import time
+import tracemalloc
+from bloom import BloomFilter
+from fingerprint import Fingerprints
+from iblt_slim import SIBLT, ArraySIBLT
+from merkle_tree import PartialMerkleTree
+from protoblock import ProtoBlock
+from transport import LinkProfile, LoopbackNetwork, run_simulated
+from workload import Workload, random_bytes
+
+# Micro-benchmarks for the protocol data structures
+# Run with python bench.py, or python bench.py --suite for the benchmark suite over synthetic workloads,
+# whose results can be written as JSON lines with --json to compare runs
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+def random_keys(rng, n, key_size):
+    return [random_bytes(rng, key_size) for i in range(n)]
+
+def subtracted_iblts(cls, n_common, n_diff, key_size, cell_overhead=3.0, seed=0):
+    # IBLTs over two sets sharing n_common keys and differing in n_diff keys, one already subtracted from the other
+    rng = random.Random(seed)
+    common = random_keys(rng, n_common, key_size)
+    a_only = random_keys(rng, n_diff // 2, key_size)
+    b_only = random_keys(rng, n_diff - n_diff // 2, key_size)
+
+    n_cells = int(cell_overhead * n_diff) + 1
+    iblt_a = cls(n_cells, key_size, 4)
+    iblt_a.encode(common + a_only)
+    iblt_b = cls(n_cells, key_size, 4)
+    iblt_b.encode(common + b_only)
+    iblt_a.subtract(iblt_b)
+    return iblt_a
+
+def bench_iblt_decode(diffs=(100, 300, 1000, 3000), n_common=10000, key_size=6, slow_limit=1000):
+    # Compare the rescanning SIBLT decoder with the worklist ArraySIBLT decoder on pair sized keys
+    print('IBLT decode (%d common keys, %d byte keys)' % (n_common, key_size))
+    print('%10s %14s %14s' % ('diff', 'SIBLT (s)', 'ArraySIBLT (s)'))
+    for n_diff in diffs:
+        if n_diff <= slow_limit:
+            t_slow, result = timed(subtracted_iblts(SIBLT, n_common, n_diff, key_size).decode)
+            assert result[0] == 'Success'
+            t_slow = '%.4f' % t_slow
+        else:
+            t_slow = '-'
+        t_fast, result = timed(subtracted_iblts(ArraySIBLT, n_common, n_diff, key_size).decode)
+        assert result[0] == 'Success'
+        print('%10d %14s %14.4f' % (n_diff, t_slow, t_fast))
+
+def missing_tx_segments(rng, n_missing, segment_length=4, id_size=8):
+    # Segments shaped like Node.missing_response, transactions are hex tx hashes as in the mempool
+    segments = []
+    for i in range(0, n_missing, segment_length):
+        txs = [random_bytes(rng, 32).hex() for j in range(min(segment_length, n_missing - i))]
+        segments.append((random_bytes(rng, id_size), txs))
+    segments[-1] = (msg_codec.END_OF_BLOCK, segments[-1][1])
+    return segments
+
+def bench_msg_codec(sizes=(10, 100, 1000, 10000), repeats=10):
+    # Compare pickle with msg_codec for the GET_GLBLKDAT and GLBLKTX payloads
+    rng = random.Random(0)
+    codecs = {
+        'GET_GLBLKDAT': (cpickle.dumps, cpickle.loads, msg_codec.encode_missing_ids, msg_codec.decode_missing_ids),
+        'GLBLKTX': (cpickle.dumps, cpickle.loads, msg_codec.encode_missing_txs, msg_codec.decode_missing_txs),
+    }
+    print('Message codecs (%d repeats)' % repeats)
+    print('%14s %8s %10s %10s %12s %12s %12s %12s' % ('message', 'n', 'pickle B', 'codec B', 'pickle enc', 'codec enc', 'pickle dec', 'codec dec'))
+    for n in sizes:
+        payloads = {'GET_GLBLKDAT': random_keys(rng, n, 8), 'GLBLKTX': missing_tx_segments(rng, n)}
+        for name, (p_enc, p_dec, c_enc, c_dec) in codecs.items():
+            obj = payloads[name]
+            p_b, c_b = p_enc(obj), c_enc(obj)
+            assert c_dec(c_b) == p_dec(p_b)
+            t = [timed(lambda: [f(x) for i in range(repeats)])[0] / repeats for f, x in ((p_enc, obj), (c_enc, obj), (p_dec, p_b), (c_dec, c_b))]
+            print('%14s %8d %10d %10d %12.6f %12.6f %12.6f %12.6f' % (name, n, len(p_b), len(c_b), *t))
+
+def bench_merkle(sizes=(10**4, 10**5, 10**6)):
+    # Time of building a block's Merkle tree, permuting its top nodes, walking its leafs and climbing it to the root
+    # Peak memory of building and climbing is measured in a second, untimed pass as tracing slows allocation
+    rng = random.Random(0)
+    print('Merkle tree')
+    print('%10s %12s %12s %12s %12s %12s' % ('leafs', 'build (s)', 'permute (s)', 'leafs (s)', 'root (s)', 'peak MiB'))
+    for n in sizes:
+        leaf_values = random_keys(rng, n, 32)
+        t_build, tree = timed(PartialMerkleTree.from_leaf_values, leaf_values)
+        t_permute, _ = timed(tree.rotate)
+        t_leafs, _ = timed(tree.get_leafs)
+        t_root, _ = timed(tree.make_tree)
+
+        tracemalloc.start()
+        PartialMerkleTree.from_leaf_values(leaf_values).make_tree()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%10d %12.4f %12.4f %12.4f %12.4f %12.1f' % (n, t_build, t_permute, t_leafs, t_root, peak / 2**20))
+
+def bench_merkle_root(n=10**6, swaps=(1, 10, 100, 1000)):
+    # Root check after swapping k pairs of adjacent leafs, against hashing the whole tree again
+    rng = random.Random(0)
+    tree = PartialMerkleTree.from_leaf_values(random_keys(rng, n, 32))
+    t_full, _ = timed(tree.get_root)
+    print('Merkle root (%d leafs, full %.4f s)' % (n, t_full))
+    print('%10s %14s' % ('swaps', 'root (s)'))
+    for k in swaps:
+        order = np.arange(len(tree.top_nodes))
+        for i in rng.sample(range(0, len(order) - 1, 2), k):
+            order[i], order[i + 1] = order[i + 1], order[i]
+        tree.permute(order)
+        t_root, _ = timed(tree.get_root)
+        print('%10d %14.6f' % (k, t_root))
+
+def bench_remove_leafs(n=10**5, removed=(1, 10, 100, 1000)):
+    # Root check after removing k leafs from a tree whose root is cached, as remove_from_block does, against building
+    # the tree of the remaining leafs again. Leafs are removed from the end, where parents lose their right children,
+    # and from random positions
+    rng = random.Random(0)
+    leaf_values = random_keys(rng, n, 32)
+    print('Merkle leaf removal (%d leafs)' % n)
+    print('%10s %8s %12s %12s' % ('removed', 'from', 'remove (s)', 'rebuild (s)'))
+    for k in removed:
+        for where, values in (('end', leaf_values[n - k:]), ('random', rng.sample(leaf_values, k))):
+            tree = PartialMerkleTree.from_leaf_values(leaf_values)
+            tree.get_root()
+            t_remove, root = timed(lambda: (tree.remove_leafs(values), tree.get_root())[1])
+            rest = [value for value in leaf_values if value not in set(values)]
+            t_rebuild, expected = timed(lambda: PartialMerkleTree.from_leaf_values(rest).get_root())
+            assert root == expected, 'Removing leafs left a stale root'
+            print('%10d %8s %12.4f %12.4f' % (k, where, t_remove, t_rebuild))
+
+def bench_reconcile_order(sizes=(10**4, 10**5, 10**6), n_swaps=100):
+    # One order reconciliation round at the leafs after swapping adjacent leafs
+    rng = random.Random(0)
+    print('Reconcile order (%d adjacent swaps)' % n_swaps)
+    print('%10s %14s' % ('leafs', 'round (s)'))
+    for n in sizes:
+        leaf_values = random_keys(rng, n, 32)
+        swapped = list(leaf_values)
+        for i in rng.sample(range(n - 1), n_swaps):
+            swapped[i], swapped[i + 1] = swapped[i + 1], swapped[i]
+        pairs = set(zip(leaf_values[::2], leaf_values[1::2]))
+        missing_pairs = [pair for pair in zip(swapped[::2], swapped[1::2]) if pair not in pairs]
+
+        tree = PartialMerkleTree.from_leaf_values(leaf_values)
+        t_round, _ = timed(tree.reconcile_order, missing_pairs)
+        print('%10d %14.4f' % (n, t_round))
+
+def bench_protoblock(n=10**5, missing=(10, 100, 1000, 10000)):
+    # Receiver reconstruction: insert k missing transactions before their next IDs, then take the leafs
+    rng = random.Random(0)
+    tx_ids = random_keys(rng, n, 32)
+    print('Protoblock reconstruction (%d transactions)' % n)
+    print('%10s %12s %14s' % ('missing', 'list (s)', 'ProtoBlock (s)'))
+    for k in missing:
+        inserts = [(random_bytes(rng, 32), next_id) for next_id in rng.sample(tx_ids, k)]
+
+        def with_list():
+            block = list(tx_ids)
+            for tx_id, next_id in inserts:
+                block.insert(block.index(next_id), tx_id)
+            return block
+
+        def with_protoblock():
+            block = ProtoBlock(tx_ids)
+            for tx_id, next_id in inserts:
+                block.insert_before(tx_id, next_id)
+            return block.to_list()
+
+        t_list, a = timed(with_list)
+        t_proto, b = timed(with_protoblock)
+        assert a == b
+        print('%10d %12.4f %14.4f' % (k, t_list, t_proto))
+
+def bench_sharded_filter(n=2 * 10**5, workers=(1, 2, 4, 8), n_cells=1000, key_size=8):
+    # Filtering a mempool against a block's Bloom filter and building its IBLT, in process and over worker processes
+    rng = random.Random(0)
+    tx_ids = random_keys(rng, n, 32)
+    bloom = filter_ops.create_bloom(tx_ids[::2], n // 2, 0.01)
+    print('Sharded mempool filter (%d transactions, %d cores)' % (n, os.cpu_count()))
+    print('%10s %12s' % ('workers', 'filter (s)'))
+
+    def in_process():
+        passed = [tx_id for tx_id, p in zip(tx_ids, bloom.contains_many(tx_ids)) if p]
+        return passed, filter_ops.create_iblt([tx_id[:key_size] for tx_id in passed], n_cells, key_size=key_size)
+
+    t, (expected, _) = timed(in_process)
+    print('%10s %12.4f' % ('-', t))
+    for n_workers in workers:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            # Start the workers before timing
+            list(executor.map(abs, range(n_workers)))
+            t, (passed, _) = timed(filter_ops.sharded_filter, executor, n_workers, bloom, tx_ids, key_size, n_cells)
+        assert passed == expected
+        print('%10d %12.4f' % (n_workers, t))
+
+def bench_fingerprints(pools=(10**4, 10**5, 2 * 10**5), block_size=5000, n_cells=1000, key_size=8, repeats=5):
+    # Filtering a mempool against a block's Bloom filter and building the IBLT of what passes, as prereconcile does,
+    # hashing every transaction against looking hashes up in the pool's fingerprints (best of repeats)
+    rng = random.Random(0)
+    print('Fingerprinted mempool filter (%d transaction block)' % block_size)
+    print('%10s %16s %12s %18s' % ('pool', 'fingerprint (s)', 'hashed (s)', 'fingerprinted (s)'))
+    for n in pools:
+        tx_ids = random_keys(rng, n, 32)
+        block = tx_ids[::max(1, n // block_size)]
+        bloom = filter_ops.create_bloom(block, len(block), 0.01)
+        iblt_other = filter_ops.create_iblt([tx_id[:key_size] for tx_id in block], n_cells, key_size=key_size, partitioned=True)
+        fingerprints = Fingerprints(key_size)
+        t_add, _ = timed(fingerprints.add, tx_ids)
+
+        def hashed():
+            passed = [tx_id for tx_id, p in zip(tx_ids, bloom.contains_many(tx_ids)) if p]
+            return filter_ops.create_iblt_like([tx_id[:key_size] for tx_id in passed], iblt_other, key_size)
+
+        def fingerprinted():
+            rows = fingerprints.pool_rows(tx_ids)
+            mask = bloom.contains_many(tx_ids, fingerprints.bloom_digests(rows))
+            passed = [tx_id for tx_id, p in zip(tx_ids, mask) if p]
+            return filter_ops.create_iblt_like([tx_id[:key_size] for tx_id in passed], iblt_other, key_size,
+                                               fingerprints, rows[mask])
+
+        t_hashed = min(timed(hashed)[0] for i in range(repeats))
+        t_fingerprinted = min(timed(fingerprinted)[0] for i in range(repeats))
+        assert hashed().serialise() == fingerprinted().serialise()
+        print('%10d %16.4f %12.4f %18.4f' % (n, t_add, t_hashed, t_fingerprinted))
+
+# Machine readable results of the benchmark suite
+RESULTS = []
+
+def report(bench, n, seconds, **fields):
+    RESULTS.append({'bench': bench, 'n': n, 'seconds': seconds, **fields})
+    print('%-28s %10d %12.4f  %s' % (bench, n, seconds, ' '.join('%s=%s' % item for item in fields.items())))
+
+def bench_bloom(workload, pool_tx_ids, fpr=0.01):
+    n = len(workload.block_tx_ids)
+    bloom = BloomFilter(n, fpr)
+    t, _ = timed(bloom.add_many, workload.block_tx_ids)
+    report('bloom_add', n, t)
+    t, passed = timed(bloom.contains_many, pool_tx_ids)
+    report('bloom_check', len(pool_tx_ids), t)
+    return [tx_id for tx_id, p in zip(pool_tx_ids, passed) if p]
+
+def bench_iblt(workload, passed, slow_limit=10**4, key_size=8):
+    # IBLTs over the block and the receiver's Bloom filtered pool, sized by the planner for their difference
+    # The pure python SIBLT is only run up to slow_limit transactions
+    n = len(workload.block_tx_ids)
+    block_keys = [tx_id[:key_size] for tx_id in workload.block_tx_ids]
+    passed_keys = [tx_id[:key_size] for tx_id in passed]
+    n_diff = len(set(block_keys) ^ set(passed_keys))
+    fpr, n_cells, n_hashes = param_planner.plan(n, 0, n_diff, 1 + key_size + 4)
+
+    tables = {'SIBLT': lambda: SIBLT(n_cells, key_size, 4, n_hashes),
+              'ArraySIBLT': lambda: ArraySIBLT(n_cells, key_size, 4, n_hashes, partitioned=True)}
+    for impl, make in tables.items():
+        if impl == 'SIBLT' and n > slow_limit:
+            continue
+        iblt = make()
+        t, _ = timed(iblt.encode, block_keys)
+        report('iblt_encode', n, t, impl=impl)
+        other = make()
+        other.encode(passed_keys)
+        t, _ = timed(iblt.subtract, other)
+        report('iblt_subtract', n, t, impl=impl)
+        t, result = timed(iblt.decode)
+        report('iblt_decode', n, t, impl=impl, diff=n_diff, cells=n_cells, outcome=result[0])
+
+def bench_merkle_workload(workload):
+    # Build and root the sender's tree, then one reconciliation round of the receiver's arrival order at the leafs
+    n = len(workload.block_tx_ids)
+    t_build, tree = timed(PartialMerkleTree.from_leaf_values, workload.block_tx_ids)
+    t_root, _ = timed(tree.get_root)
+    report('merkle_build', n, t_build + t_root)
+
+    block = set(workload.block_tx_ids)
+    arrival = [tx_id for tx_id in (bt.sha256(tx.encode()) for tx in workload.sender_pool) if tx_id in block]
+    guess = PartialMerkleTree.from_leaf_values(arrival)
+    guess_pairs = set(guess.get_top_value_pairs())
+    missing_pairs = [pair for pair in tree.get_top_value_pairs() if pair not in guess_pairs]
+    t, _ = timed(guess.reconcile_order, missing_pairs)
+    report('merkle_reconcile', n, t, pairs=len(missing_pairs))
+
+def replay_relay(workload, est_missing_tx_perc, est_missing_pair_perc):
+    # The steps of send_block and listen_for_blocks in one process, extensions included, without the network
+    # Messages are still encoded and decoded as on the wire, their sizes are counted per type
+    # Returns the sender, the receiver, whose telemetry holds the time of each phase, and the bytes sent
+    from networking import NetworkMsg, ExtRequest, EXT_TX_PHASE, EXT_ORDER_PHASE, encode_message, decode_message
+    sender, receiver = workload.nodes()
+    sent = {}
+    extensions = {}
+
+    def wire(typ, obj):
+        fields = encode_message(typ, obj)
+        sent[typ.name] = sent.get(typ.name, 0) + sum(len(field) for field in fields)
+        return decode_message(typ, [bytes(field) for field in fields])
+
+    def extend(phase, sketch, height, difference):
+        # At most max_extensions per IBLT, as listen_for_blocks asks for
+        assert extensions.setdefault((phase, height), 0) < receiver.max_extensions, \
+            'Relay replay IBLT decoding failure after %d extensions' % receiver.max_extensions
+        extensions[(phase, height)] += 1
+        request = wire(NetworkMsg.GET_GLBLKEXT, ExtRequest(phase, height, difference.next_seed, difference.n_cells,
+                                                           difference.n_hashes))
+        ext_iblt = wire(NetworkMsg.GLBLKEXT, sender.extension_sketch(request, levels))
+        return receiver.decode_difference(difference, sketch, height, ext_iblt)
+
+    sender.setup_id_encoding(sender.get_block_tx_ids())
+    merkle_root = sender.get_merkle_root()
+    levels = list(sender.order_levels())
+
+    n_pool = wire(NetworkMsg.GET_GLBLK, len(receiver.txpool))
+    bloom, iblt = wire(NetworkMsg.GLBLK, sender.block_sketch(n_pool, est_missing_tx_perc))
+    enc_missing_ids = receiver.prereconcile(bloom, iblt)
+    while enc_missing_ids is None:
+        enc_missing_ids = receiver.resolve_tx_difference(extend(EXT_TX_PHASE, 'tx', 0, receiver.tx_difference))
+    enc_missing_ids = wire(NetworkMsg.GET_GLBLKDAT, enc_missing_ids)
+    receiver.finalize_protoblock(wire(NetworkMsg.GLBLKTX, sender.missing_response(enc_missing_ids)))
+
+    height = 0
+    while len(receiver.partial_tree.top_nodes) > 1:
+        pair_bloom, pair_iblt, digest = wire(NetworkMsg.GLBLKORD, sender.order_sketch(levels[height](), est_missing_pair_perc))
+        receiver.setup_pair_encoding(receiver.partial_tree.get_top_values())
+        empty_missing_flag = receiver.reconcile_pairs(pair_bloom, pair_iblt, height, digest)
+        assert receiver.pair_difference is not None, 'Pair encoding mismatch at height %d' % height
+        while empty_missing_flag is None:
+            empty_missing_flag = receiver.resolve_pair_difference(extend(EXT_ORDER_PHASE, 'order', height,
+                                                                         receiver.pair_difference))
+        receiver.partial_tree.add_merkle_level()
+        height += 1
+        if empty_missing_flag and receiver.get_merkle_root() == merkle_root:
+            break
+    assert receiver.get_merkle_root() == merkle_root, 'Relay replay did not reconcile the block'
+    return sender, receiver, sent
+
+def bench_relay(workload, est_missing_tx_perc=0.01, est_missing_pair_perc=0.01):
+    n = len(workload.block_tx_ids)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t, (sender, receiver, sent) = timed(replay_relay, workload, est_missing_tx_perc, est_missing_pair_perc)
+    report('relay', n, t, bytes=sum(sent.values()), **{'bytes_' + typ: length for typ, length in sent.items()})
+    for side, node in (('sender', sender), ('receiver', receiver)):
+        snapshot = node.telemetry.snapshot()
+        for name, total in snapshot['phases'].items():
+            report('relay_' + name, n, total['wall'], side=side, cpu=round(total['cpu'], 6), count=total['count'])
+    extensions = sum(1 for decode in receiver.telemetry.snapshot()['decodes'] if decode['outcome'] != 'Success')
+    report('relay_extensions', n, 0.0, count=extensions)
+
+def simulate_relay(workload, profile, seed=0, est_missing_tx_perc=0.01, est_missing_pair_perc=0.01, order_window=4):
+    # Relay between two Nodes over an in-memory link, in simulated time
+    # Returns the simulated seconds from connecting until the receiver has the block, the same for the same seed
+    # The relay ends later, once COMPLETE arrives, but that carries the receiver's real timings
+    network = LoopbackNetwork(profile, seed)
+    sender, receiver = workload.nodes(sender_port=8001, receiver_port=8002, transport=network)
+
+    async def send():
+        await sender.init_server()
+        peers = await sender.server.wait_for_peers(1)
+        await sender.send_block(est_missing_tx_perc, est_missing_pair_perc, peers, order_window)
+
+    async def receive():
+        await receiver.init_server()
+        await receiver.listen_for_blocks(await receiver.open_connection('localhost', 8001))
+        return asyncio.get_event_loop().time()
+
+    async def relay():
+        _, received = await asyncio.gather(send(), receive())
+        sender.close_connection()
+        receiver.close_connection()
+        return received
+
+    seconds, _ = run_simulated(relay())
+    assert receiver.get_merkle_root() == sender.get_merkle_root(), 'Simulated relay did not reconcile the block'
+    return seconds
+
+def bench_link(workload, profile):
+    n = len(workload.block_tx_ids)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t, simulated = timed(simulate_relay, workload, profile, workload.seed)
+    report('link_relay', n, t, simulated=round(simulated, 6), latency=profile.latency, bandwidth=profile.bandwidth,
+           jitter=profile.jitter)
+
+def bench_suite(sizes=(10**3, 10**4, 10**5, 10**6), seed=0, missing=0.01, excess=1.0, runs_per_1000=1,
+                link=LinkProfile(0.05, 10**6, 0.005)):
+    # Seeded workloads with missing, excess and reordered transactions, from the data structures up to whole relays
+    print('Benchmark suite (seed %d)' % seed)
+    print('%-28s %10s %12s' % ('bench', 'n', 'seconds'))
+    for n in sizes:
+        workload = Workload.generate(n, seed, missing=missing, excess=excess, reordered_runs=max(1, n * runs_per_1000 // 1000))
+        pool_tx_ids = [bt.sha256(tx.encode()) for tx in workload.receiver_pool]
+        passed = bench_bloom(workload, pool_tx_ids)
+        bench_iblt(workload, passed)
+        bench_merkle_workload(workload)
+        bench_relay(workload)
+        bench_link(workload, link)
+
+def write_results(path, **run):
+    # One JSON line per result, tagged with the parameters of the run
+    run.update(python=platform.python_version(), time=time.time())
+    with open(path, 'w') as f:
+        for result in RESULTS:
+            f.write(json.dumps({**run, **result}) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', action='store_true', help='run the benchmark suite over synthetic workloads')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**3, 10**4, 10**5, 10**6], help='block sizes of the suite')
+    parser.add_argument('--seed', type=int, default=0, help='workload seed of the suite')
+    parser.add_argument('--json', help='write the suite results to this file as JSON lines')
+    parser.add_argument('--link', type=float, nargs=3, default=[0.05, 10**6, 0.005], metavar=('LATENCY', 'BANDWIDTH', 'JITTER'),
+                        help='simulated link of the suite, one way latency (s), bandwidth (bytes/s) and jitter (s)')
+    args = parser.parse_args()
+
+    if args.suite:
+        bench_suite(args.sizes, args.seed, link=LinkProfile(*args.link))
+        if args.json:
+            write_results(args.json, seed=args.seed)
+    else:
+        bench_iblt_decode()
+        bench_msg_codec()
+        bench_merkle()
+        bench_merkle_root()
+        bench_remove_leafs()
+        bench_reconcile_order()
+        bench_protoblock()
+        bench_sharded_filter()
+        bench_fingerprints()
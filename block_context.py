@@ -0,0 +1,39 @@
+import msg_codec
+
+# Sender side view of one block, built once per block and shared by every relay of it
+# Holds the leafs in block order, the position of each transaction, the short ID of each transaction
+# under the block's ID encoding, the transaction bodies already serialised for GLBLKTX and, if the node
+# fingerprints its txpool, the fingerprint of each transaction
+
+class BlockContext:
+    def __init__(self, tree, txpool, id_encoding_scheme, fingerprints=None):
+        self.tree = tree
+        self.id_encoding_scheme = id_encoding_scheme
+        self.tx_ids = tree.get_leafs()
+        self.positions = dict(zip(self.tx_ids, range(len(self.tx_ids))))
+        self.encoded_ids = [id_encoding_scheme.encode(tx_id) for tx_id in self.tx_ids]
+        self.tx_bodies = [txpool[tx_id].encode() for tx_id in self.tx_ids]
+        self.fingerprint_rows = fingerprints.rows(self.tx_ids) if fingerprints is not None else None
+
+    def __len__(self):
+        return len(self.tx_ids)
+
+    def is_current(self, tree, id_encoding_scheme):
+        return self.tree is tree and self.id_encoding_scheme is id_encoding_scheme
+
+    def missing_segments(self, missing_tx_ids):
+        # Group the missing transactions into runs of consecutive positions in the block
+        # Each run is labelled with the short ID of the transaction following it, or the end of block flag
+        positions = sorted(self.positions[tx_id] for tx_id in missing_tx_ids)
+        segments = []
+        segment = []
+        for i, position in enumerate(positions):
+            segment.append(self.tx_bodies[position])
+            if i + 1 < len(positions) and positions[i + 1] == position + 1:
+                continue
+            if position + 1 == len(self.tx_ids):
+                segments.append((msg_codec.END_OF_BLOCK, segment))
+            else:
+                segments.append((self.encoded_ids[position + 1], segment))
+            segment = []
+        return segments
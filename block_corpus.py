@@ -0,0 +1,83 @@
+import mmap
+import numpy as np
+import struct
+
+# Binary corpus of block transaction IDs, for replaying many historical blocks without parsing their JSON
+# Layout: header, then the txids of every block as one contiguous array of 32 byte IDs, then the offset table
+# The offset table holds one entry per block: its hash, the byte offset of its first txid and its txid count
+# The file is memory mapped, so a block's txids are a slice of the map and aren't copied until used
+
+MAGIC = b'GLCORP'
+VERSION = 1
+HEADER = struct.Struct('>6sBIQ') # Magic, version, number of blocks, offset table offset
+ENTRY = struct.Struct('>32sQI') # Block hash, txids offset, txid count
+TXID_SIZE = 32
+
+def write_corpus(path, blocks):
+    # blocks: iterable of (block hash, txid hex strings), consumed one block at a time
+    # The header is rewritten once the offset table position and block count are known
+    entries = []
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        for block_hash, tx_hashes in blocks:
+            offset = f.tell()
+            txids = b''.join(bytes.fromhex(tx_hash) for tx_hash in tx_hashes)
+            assert len(txids) == TXID_SIZE * len(tx_hashes), 'Transaction IDs must be 32 bytes'
+            f.write(txids)
+            entries.append(ENTRY.pack(bytes.fromhex(block_hash), offset, len(tx_hashes)))
+
+        index_offset = f.tell()
+        f.write(b''.join(entries))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), index_offset))
+    return len(entries)
+
+class BlockCorpus:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_blocks, index_offset = HEADER.unpack_from(self.map, 0)
+        assert magic == MAGIC, 'Not a block corpus'
+        assert version == VERSION, 'Unsupported block corpus version'
+
+        # Block hash hex -> (txids offset, txid count)
+        self.index = {}
+        for i in range(n_blocks):
+            block_hash, offset, count = ENTRY.unpack_from(self.map, index_offset + i * ENTRY.size)
+            self.index[block_hash.hex()] = (offset, count)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.index
+
+    def block_hashes(self):
+        return list(self.index)
+
+    def txids(self, block_hash):
+        # Zero copy view of the block's txids, TXID_SIZE bytes each
+        offset, count = self.index[block_hash]
+        return memoryview(self.map)[offset:offset + TXID_SIZE * count]
+
+    def txid_matrix(self, block_hash):
+        # Zero copy view of the block's txids as a (count, TXID_SIZE) byte matrix
+        offset, count = self.index[block_hash]
+        return np.frombuffer(self.map, dtype=np.uint8, count=TXID_SIZE * count, offset=offset).reshape(count, TXID_SIZE)
+
+    def tx_hashes(self, block_hash):
+        # Txid hex strings, as blocks_util.getTxsFromBlock returns them
+        txids = self.txids(block_hash)
+        return [txids[i:i + TXID_SIZE].hex() for i in range(0, len(txids), TXID_SIZE)]
+
+    def close(self):
+        # Views returned by txids and txid_matrix must be released first
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
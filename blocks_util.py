@@ -1,8 +1,10 @@
 import requests, json, os
+from block_corpus import BlockCorpus, write_corpus
 
 #URIBASE = "https://bch-chain.api.btc.com/v3/block/"
 URIBASE = 'https://blockchain.info/rawblock/'
 DATADIR = "./blockdata/"
+CORPUS = os.path.join(DATADIR, "blocks.corpus")
 
 if not os.path.exists(DATADIR):
     os.makedirs(DATADIR)
@@ -14,7 +16,7 @@ def saveCache(filename, data):
 def getCached(filename):
     fname = os.path.join(DATADIR, filename)
     if(os.path.exists(fname)):
-        with open(fname) as f:
+        with open(fname, 'rb') as f:
             return f.read()
     else:
         return None
@@ -28,7 +30,25 @@ def getBlock(hash):
         saveCache(hash + ".block", data)
     return json.loads(data)
 
+corpus = None
+
+def getCorpus():
+    # Binary corpus of the cached blocks' txids, if it has been imported
+    global corpus
+    if corpus is None and os.path.exists(CORPUS):
+        corpus = BlockCorpus(CORPUS)
+    return corpus
+
+def importCache(path=CORPUS):
+    # Convert the JSON block cache into a binary corpus, parsing each block once
+    # Blocks are streamed into the corpus, so only one block's JSON is held at a time
+    hashes = sorted(fname[:-len(".block")] for fname in os.listdir(DATADIR) if fname.endswith(".block"))
+    blocks = ((hash, [tx["hash"] for tx in getBlock(hash)["tx"]]) for hash in hashes)
+    return write_corpus(path, blocks)
+
 def getTxsFromBlock(hash):
+    if getCorpus() is not None and hash in corpus:
+        return corpus.tx_hashes(hash)
     jobj = getBlock(hash)
     retval = []
     for tx in jobj["tx"]:
@@ -37,4 +57,8 @@ def getTxsFromBlock(hash):
 
 # For BTC block #497373
 orphan = "0000000000000000000d450f4d1ccbc5107f1eaa98284c2c87b6a0702c49c439"
-actual = "0000000000000000000907aed7dfdea5e568283b9548a4fc9aed0fc3498acdab"
\ No newline at end of file
+actual = "0000000000000000000907aed7dfdea5e568283b9548a4fc9aed0fc3498acdab"
+
+if __name__ == '__main__':
+    # Import the JSON block cache into the corpus
+    print('Imported %d blocks into %s' % (importCache(), CORPUS))
@@ -7,16 +7,20 @@ class BloomFilter(object):
     Class for Bloom filter, using murmur3 hash function
     '''
 
-    def __init__(self, capacity, error_rate):
+    def __init__(self, capacity, error_rate, double_hashing=True):
         '''
         items_count : int
             Number of items expected to be stored in bloom filter
         fp_prob : float
             False Positive probability in decimal
+        double_hashing : bool
+            Derive the k indices from one 128 bit murmur digest
+            rather than k seeded 32 bit murmur hashes
         '''
         # False possible probability in decimal
         self.error_rate = error_rate
         self.capacity = capacity
+        self.double_hashing = double_hashing
 
         # Size of bit array to use
         self.size = self.get_size(capacity, error_rate)
@@ -25,14 +29,14 @@ class BloomFilter(object):
         self.hash_count = self.get_hash_count(self.size, capacity)
 
         # Bit array of given size
-        self.bit_array = bitarray(self.size)
+        self.bit_array = bitarray(self.size, endian='big')
 
         # initialize all bits as 0
         self.bit_array.setall(0)
 
     def serialise(self):
         import msgpack
-        payload = [self.capacity, self.error_rate, self.bit_array.tobytes()]
+        payload = [self.capacity, self.error_rate, self.bit_array.tobytes(), int(self.double_hashing)]
         b = msgpack.packb(payload)
         return b
 
@@ -42,24 +46,51 @@ class BloomFilter(object):
         payload = msgpack.unpackb(b)
         capacity = payload[0]
         error_rate = payload[1]
-        bloom = cls(capacity, error_rate)
-        bloom.bit_array = bitarray(0)
+        # Filters without the flag come from peers using seeded hashes
+        double_hashing = len(payload) > 3 and bool(payload[3])
+        bloom = cls(capacity, error_rate, double_hashing)
+        bloom.bit_array = bitarray(0, endian='big')
         bloom.bit_array.frombytes(payload[2])
         return bloom
 
 
+    def indices(self, item):
+        '''
+        Return the k bit indices of an item
+        '''
+        if self.double_hashing:
+            # i-th index is h1 + i * h2 over the two halves of a 128 bit digest
+            h1, h2 = mmh3.hash64(item, signed=False)
+            return [((h1 + i * h2) & 0xffffffffffffffff) % self.size for i in range(self.hash_count)]
+
+        # i work as seed to mmh3.hash() function
+        # With different seed, digest created is different
+        return [mmh3.hash(item, i) % self.size for i in range(self.hash_count)]
+
+    def indices_many(self, items, digests=None):
+        '''
+        Return the bit indices of a batch of items, one row per item
+        digests : array
+            The items' 128 bit murmur digests as two little endian 64 bit halves per row,
+            if already known (see fingerprint.py)
+        '''
+        if not self.double_hashing:
+            rows = [self.indices(item) for item in items]
+            return np.array(rows, dtype=np.int64).reshape(len(rows), self.hash_count)
+
+        # hash_bytes is the same 128 bit digest as hash64, little endian
+        if digests is None:
+            digests = np.frombuffer(b''.join([mmh3.hash_bytes(item) for item in items]), dtype='<u8').reshape(-1, 2)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            indices = digests[:, :1] + steps * digests[:, 1:]
+        return (indices % np.uint64(self.size)).astype(np.int64)
+
     def add(self, item):
         '''
         Add an item in the filter
         '''
-        #digests = []
-        for i in range(self.hash_count):
-            # create digest for given item.
-            # i work as seed to mmh3.hash() function
-            # With different seed, digest created is different
-            digest = mmh3.hash(item, i) % self.size
-            #digests.append(digest)
-
+        for digest in self.indices(item):
             # set the bit True in bit_array
             self.bit_array[digest] = True
 
@@ -67,8 +98,7 @@ class BloomFilter(object):
         '''
         Check for existence of an item in filter
         '''
-        for i in range(self.hash_count):
-            digest = mmh3.hash(item, i) % self.size
+        for digest in self.indices(item):
             if self.bit_array[digest] == False:
                 # if any of bit is False then,its not present
                 # in filter
@@ -76,6 +106,31 @@ class BloomFilter(object):
                 return False
         return True
 
+    def add_many(self, items, digests=None):
+        '''
+        Add a batch of items in the filter
+        '''
+        indices = self.indices_many(items, digests).ravel()
+        if len(indices) == 0:
+            return
+
+        # Set the bits on an unpacked copy of the (big endian) bit array
+        n_bits = len(self.bit_array)
+        bits = np.unpackbits(np.frombuffer(self.bit_array.tobytes(), dtype=np.uint8))
+        bits[indices] = 1
+        self.bit_array = bitarray(0, endian='big')
+        self.bit_array.frombytes(np.packbits(bits).tobytes())
+        del self.bit_array[n_bits:]
+
+    def contains_many(self, items, digests=None):
+        '''
+        Check a batch of items, returns a boolean mask with one entry per item
+        '''
+        indices = self.indices_many(items, digests)
+        buf = np.frombuffer(self.bit_array.tobytes(), dtype=np.uint8)
+        bits = buf[indices >> 3] & (0x80 >> (indices & 7)).astype(np.uint8)
+        return (bits != 0).all(axis=1)
+
     def __contains__(self, item):
         return self.check(item)
 
@@ -1,4 +1,5 @@
 import hashlib
+import numpy as np
 
 def sha256(preimage):
     return hashlib.sha256(preimage).digest()
@@ -26,6 +27,118 @@ def reverse(b):
 def concat(x, y):
     return x + y
 
+def to_matrix(keys, key_size):
+    # Stack equal length byte strings into the rows of a uint8 matrix
+    if isinstance(keys, np.ndarray):
+        return keys.astype(np.uint8, copy=False).reshape(-1, key_size)
+    return np.frombuffer(b''.join(keys), dtype=np.uint8).reshape(-1, key_size)
+
+def zigzag_encode(values):
+    # Map signed ints to unsigned so small magnitudes stay small: 0, -1, 1, -2 -> 0, 1, 2, 3
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values >> np.uint64(1)) ^ (np.uint64(0) - (values & np.uint64(1)))).view(np.int64)
+
+def varint(n):
+    # Single LEB128 varint, see pack_varints
+    parts = []
+    while n >= 0x80:
+        parts.append((n & 0x7f) | 0x80)
+        n >>= 7
+    parts.append(n)
+    return bytes(parts)
+
+def read_varint(buf, offset):
+    # Read a single varint, returns the value and the offset after it
+    n = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+def pack_varints(values):
+    # LEB128 style varints, 7 bits per byte with the high bit flagging a following byte
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.zeros(int(n_bytes.sum()), dtype=np.uint8)
+    for j in range(int(n_bytes.max(initial=0))):
+        sel = n_bytes > j
+        byte = (values[sel] >> np.uint64(7 * j)) & np.uint64(0x7f)
+        byte |= np.where(n_bytes[sel] > j + 1, 0x80, 0).astype(np.uint64)
+        out[starts[sel] + j] = byte
+    return out.tobytes()
+
+def unpack_varints(buf, count, offset=0):
+    # Inverse of pack_varints, returns the values and the number of bytes read
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64), 0
+    b = np.frombuffer(buf, dtype=np.uint8, offset=offset)
+    ends = np.flatnonzero(b < 0x80)[:count] + 1
+    assert len(ends) == count, 'Truncated varints!'
+    b = b[:ends[-1]].astype(np.uint64)
+
+    starts = np.concatenate(([0], ends[:-1]))
+    group = np.repeat(np.arange(count), ends - starts)
+    shifts = (np.arange(len(b)) - starts[group]) * 7
+    values = np.bitwise_or.reduceat((b & np.uint64(0x7f)) << shifts.astype(np.uint64), starts)
+    return values, int(ends[-1])
+
+def murmur3_32(keys, seed=0):
+    # Vectorised x86 32 bit murmur3 over the rows of a uint8 matrix
+    # Agrees with mmh3.hash(key, seed, signed=False) for each row
+    n_keys, length = keys.shape
+    c1 = np.uint32(0xcc9e2d51)
+    c2 = np.uint32(0x1b873593)
+    h = np.full(n_keys, seed & 0xffffffff, dtype=np.uint32)
+
+    n_blocks = length // 4
+    blocks = np.ascontiguousarray(keys[:, :4 * n_blocks]).view('<u4')
+    for i in range(n_blocks):
+        k = blocks[:, i] * c1
+        k = (k << np.uint32(15)) | (k >> np.uint32(17))
+        k *= c2
+        h ^= k
+        h = (h << np.uint32(13)) | (h >> np.uint32(19))
+        h = h * np.uint32(5) + np.uint32(0xe6546b64)
+
+    tail = keys[:, 4 * n_blocks:]
+    if tail.shape[1] > 0:
+        k = np.zeros(n_keys, dtype=np.uint32)
+        for i in range(tail.shape[1]):
+            k ^= tail[:, i].astype(np.uint32) << np.uint32(8 * i)
+        k *= c1
+        k = (k << np.uint32(15)) | (k >> np.uint32(17))
+        k *= c2
+        h ^= k
+
+    # Finalisation mix
+    h ^= np.uint32(length)
+    h ^= h >> np.uint32(16)
+    h *= np.uint32(0x85ebca6b)
+    h ^= h >> np.uint32(13)
+    h *= np.uint32(0xc2b2ae35)
+    h ^= h >> np.uint32(16)
+    return h
+
+def murmur3_32_signed(keys, seed=0):
+    # As murmur3_32 but matching the signed output of mmh3.hash(key, seed)
+    h = murmur3_32(keys, seed).astype(np.int64)
+    h[h >= 2**31] -= 2**32
+    return h
+
 # def encode(x, y):
 #     return hash(concat(x, y))[:64]
 #
@@ -47,10 +160,16 @@ def concat(x, y):
 #     return (s[:20], s[20:40])
 
 class PairEncodingScheme:
-    def __init__(self, encode, decode, length):
+    def __init__(self, encode, decode, length, encode_many=None, decode_many=None, digest=b''):
         self.encode = encode
         self.decode = decode
         self.length = length
+        self.encode_many = encode_many or (lambda pairs: [encode(*pair) for pair in pairs])
+        self.decode_many = decode_many or (lambda bs: [decode(b) for b in bs])
+
+        # Digest of the values pairs are encoded against, empty if decoding checks the values itself
+        # Peers compare digests, pairs only decode to the values they were encoded from if they match
+        self.digest = digest
 
     @classmethod
     def DoubleIdEncoding(cls, id_enc):
@@ -84,13 +203,57 @@ class PairEncodingScheme:
 
         return cls(encode, decode, 2*int_len)
 
+    @classmethod
+    def RankEncoding(cls, top_values):
+        # Pairs encoded as the ranks of both values among the sorted top values
+        # The value -> rank dict is built once per Merkle height and ranks are packed with the fewest bits
+        # that fit the number of top values, so the encoding shrinks as the tree is climbed
+        # Any rank decodes to some value, so the digest of the ranked values is the only check peers rank alike
+        ranked = sorted(set(top_values))
+        digest = sha256(b''.join(ranked))[:4]
+        rank = dict(zip(ranked, range(len(ranked))))
+        width = max(1, (len(ranked) - 1).bit_length())
+        length = (2 * width + 7) // 8
+        mask = (1 << width) - 1
+
+        def encode(x, y):
+            return ((rank[x] << width) | rank[y]).to_bytes(length, 'big')
+
+        def decode(b):
+            r = int.from_bytes(b, 'big')
+            return (ranked[r >> width], ranked[r & mask])
+
+        def encode_many(pairs):
+            if len(pairs) == 0:
+                return []
+            ranks = np.array([(rank[x], rank[y]) for x, y in pairs], dtype=np.uint64)
+            packed = (ranks[:, 0] << np.uint64(width)) | ranks[:, 1]
+            b = packed.astype('>u8').view(np.uint8).reshape(-1, 8)[:, 8 - length:].tobytes()
+            return [b[i:i + length] for i in range(0, len(b), length)]
+
+        def decode_many(bs):
+            if len(bs) == 0:
+                return []
+            padded = np.zeros((len(bs), 8), dtype=np.uint8)
+            padded[:, 8 - length:] = to_matrix(bs, length)
+            packed = padded.view('>u8').ravel()
+            firsts = (packed >> np.uint64(width)).tolist()
+            seconds = (packed & np.uint64(mask)).tolist()
+            return [(ranked[i], ranked[j]) for i, j in zip(firsts, seconds)]
+
+        return cls(encode, decode, length, encode_many, decode_many, digest)
+
 
 
 class IdEncodingScheme:
-    def __init__(self, encode, decode, length):
+    def __init__(self, encode, decode, length, decode_many=None, collisions=None):
         self.encode = encode
         self.decode = decode
         self.length = length
+        self.decode_many = decode_many or (lambda bs: [decode(b) for b in bs])
+
+        # Encoded IDs shared by more than one prior, mapped to those priors
+        self.collisions = collisions or {}
 
     @classmethod
     def BasicTruncatedEncoding(cls, priors, n_bytes=32):
@@ -109,3 +272,31 @@ class IdEncodingScheme:
             return x
 
         return cls(encode, decode, n_bytes)
+
+    @classmethod
+    def IndexedTruncatedEncoding(cls, priors, n_bytes=32):
+        # Truncation as BasicTruncatedEncoding, decoded through a prefix -> ID dict built once over the priors
+        # On a collision the last prior wins, as in BasicTruncatedEncoding, and the collision is recorded
+        index = {}
+        collisions = {}
+        for prior in priors:
+            prefix = prior[:n_bytes]
+            other = index.get(prefix)
+            if other is not None and other != prior:
+                collisions.setdefault(prefix, [other]).append(prior)
+            index[prefix] = prior
+
+        def encode(x):
+            return x[:n_bytes]
+
+        def decode(b):
+            x = index.get(b[:n_bytes])
+            assert x != None, 'Failure decoding shortened ID!'
+            return x
+
+        def decode_many(bs):
+            xs = [index.get(b[:n_bytes]) for b in bs]
+            assert None not in xs, 'Failure decoding shortened ID!'
+            return xs
+
+        return cls(encode, decode, n_bytes, decode_many, collisions)
@@ -1,73 +1,94 @@
 from bloom import BloomFilter
-from iblt_slim import SIBLT
-import numpy as np
+from iblt_slim import ArraySIBLT, decode_tables
 
-def get_iblt_missing_excess(iblt1, iblt2):
-    # Calculate subtraction of iblt2 from iblt1 then decode
-    print('Calculating IBLT Subtraction...')
-    iblt1.subtract(iblt2)
-    diff_results = iblt1.decode()
-    print('IBLT decoding result: ', diff_results[0], len(diff_results[1]), len(diff_results[2]))
-    assert diff_results[0] == 'Success', 'IBLT decoding failure'
-
-    return diff_results[1], diff_results[2]
-
-def create_bloom(set, capacity=3000, error_rate=0.001):
-    # Create Bloom filter
+def create_bloom(set, capacity=3000, error_rate=0.001, fingerprints=None, rows=None):
+    # Create Bloom filter, hashing through the set's fingerprint rows if given
     bf = BloomFilter(capacity=capacity, error_rate=error_rate)
-    for x in set:
-        bf.add(x)
+    bf.add_many(set, None if rows is None else fingerprints.bloom_digests(rows))
     return bf
 
-def create_iblt(set, n_cells = 800, n_hashes=4, key_size=32, hash_key_sum_size=4):
-    # Create IBLT
-    iblt = SIBLT(n_cells, key_size, hash_key_sum_size, n_hashes)
-    iblt.encode(set)
+def create_iblt(set, n_cells = 800, n_hashes=4, key_size=32, hash_key_sum_size=4, seed=0, partitioned=False,
+                fingerprints=None, rows=None):
+    # Create IBLT, the set being the short IDs of the fingerprint rows if given
+    iblt = ArraySIBLT(n_cells, key_size, hash_key_sum_size, n_hashes, seed, partitioned)
+    if rows is None:
+        iblt.encode(set)
+    else:
+        iblt.encode(set, *fingerprints.iblt_hashes(rows, iblt))
     return iblt
 
-def optimum_params_bf(n_block_tx, n_receiver_pool_tx, cell_size):
-    # Calculate optimum n_cells (copied from BU Graphene)
-    # TODO: Didn't have much luck with this producing optimal params
-    # TODO: Perhaps it's the fact that we're assuming that Bob's mempool is missing only one TX?
-    # TODO: Need to talk to someone about this...
-    assert(n_receiver_pool_tx >= n_block_tx - 1)
-    n_block_and_receiver_pool_tx = n_block_tx - 1
-    filter_cell_size = 1
+def create_iblt_like(set, other, key_size, fingerprints=None, rows=None):
+    # Create IBLT laid out as a peer's, so it can be subtracted from it
+    return create_iblt(set, other.n_cells, other.n_hash_functions, key_size, other.key_sum_size, other.seed, other.partitioned,
+                       fingerprints, rows)
+
+class IBLTDifference:
+    # Difference of a peer's IBLTs over its set and ours over our set
+    # If it doesn't decode the peer may send extensions, IBLTs over the same set under other seeds. Ours are built
+    # to match and all differences are peeled together, so the cells already received are not wasted
+    # Tables are kept as subtracted and copied for each decode, as peeling consumes them
+
+    def __init__(self, iblt_other, iblt, keys, key_size):
+        # keys: function returning our set, only called if an extension arrives
+        self.keys = keys
+        self.key_size = key_size
+        self.tables = []
+
+        # Peeling statistics of the last decode
+        self.stats = {}
+        self.add(iblt_other, iblt)
+
+    @property
+    def n_cells(self):
+        return sum(table.n_cells for table in self.tables)
+
+    @property
+    def n_hashes(self):
+        return self.tables[0].n_hash_functions
+
+    @property
+    def next_seed(self):
+        return max(table.seed for table in self.tables) + 1
 
-    def calc_fpr(a):
-        # Calculate error rate
-        fpr_min = 0.001
-        fpr_max = 0.999
-        return max([fpr_min, min([a / (n_receiver_pool_tx - n_block_and_receiver_pool_tx), fpr_max])])
+    def add(self, iblt_other, iblt):
+        iblt_other.subtract(iblt)
+        self.tables.append(iblt_other)
 
-    def F(a):
-        # Size of bloom
-        return np.floor(filter_cell_size * (-1 / np.log(2)**2 * n_block_tx * np.log(calc_fpr(a))/ 8))
+    def extend(self, ext_iblt):
+        # Add an extension from the peer and decode again
+        if callable(self.keys):
+            self.keys = self.keys()
+        self.add(ext_iblt, create_iblt_like(self.keys, ext_iblt, self.key_size))
+        return self.decode()
 
-    def L(a):
-        # Size of IBLT
-        n_iblt_hash = 4 # TODO: Lookup from table?
-        iblt_overhead = 1.5 # TODO: Lookup from table?
-        padded_cells = a * iblt_overhead
-        cells = n_iblt_hash * np.ceil(padded_cells / n_iblt_hash)
-        return cell_size * cells
+    def decode(self):
+        self.stats = {}
+        diff_results = decode_tables([table.copy() for table in self.tables], self.stats)
+        print('IBLT decoding result: ', diff_results[0], len(diff_results[1]), len(diff_results[2]), 'over %d cells' % self.n_cells)
+        return diff_results
 
-    # Brute force search
-    opt_diff = 1
-    opt_T = 10**6
-    for a in range(1, n_receiver_pool_tx):
-        T = F(a) + L(a)
-        if T < opt_T:
-            opt_T = T
-            opt_diff = a
+def filter_shard(bloom_b, tx_ids, key_size, n_cells, n_hashes, hash_key_sum_size, partitioned):
+    # Bloom filter one shard of a mempool and encode the passing IDs, truncated to key_size, into a partial IBLT
+    # Runs in a worker process, so the filter and IBLT cross the process boundary serialised
+    bloom = BloomFilter.deserialise(bloom_b)
+    passed = [tx_id for tx_id, p in zip(tx_ids, bloom.contains_many(tx_ids)) if p]
+    iblt = create_iblt([tx_id[:key_size] for tx_id in passed], n_cells, n_hashes, key_size, hash_key_sum_size,
+                       partitioned=partitioned)
+    return passed, iblt.serialise()
 
-    return opt_diff
+def sharded_filter(executor, n_shards, bloom, tx_ids, key_size, n_cells, n_hashes=4, hash_key_sum_size=4, partitioned=False):
+    # Split the mempool into contiguous shards filtered in parallel, then merge the results in shard order
+    # Passing IDs keep their mempool order and the partial IBLTs are summed into one
+    bloom_b = bloom.serialise()
+    shard_size = max(1, -(-len(tx_ids) // n_shards))
+    futures = [executor.submit(filter_shard, bloom_b, tx_ids[i:i + shard_size], key_size, n_cells, n_hashes,
+                               hash_key_sum_size, partitioned)
+               for i in range(0, len(tx_ids), shard_size)]
 
-def optimum_params(set_size, pool_size, percentage_set_missing, percentage_pool_excess, cell_size):
-    # Modified optimum parameters
-    # More geared to our applications?
-    fpr_min = 0.0001
-    fpr_max = 0.9999
-    opt_fpr = np.clip(set_size / (cell_size * pool_size * percentage_pool_excess * np.power(np.log(2),2)), fpr_min, fpr_max)
-    opt_n_cells = set_size * percentage_set_missing + pool_size * percentage_pool_excess * opt_fpr
-    return opt_fpr, opt_n_cells
\ No newline at end of file
+    passed = []
+    iblt = ArraySIBLT(n_cells, key_size, hash_key_sum_size, n_hashes, partitioned=partitioned)
+    for future in futures:
+        shard_passed, iblt_b = future.result()
+        passed.extend(shard_passed)
+        iblt.add(ArraySIBLT.deserialise(iblt_b))
+    return passed, iblt
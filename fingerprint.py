@@ -0,0 +1,84 @@
+import byte_tools as bt
+import hashlib as hl
+import mmh3
+import numpy as np
+
+# Per transaction fingerprints, every hash the transaction phase takes of a txid computed once
+# A fingerprint is one fixed width row holding
+#   the 128 bit murmur digest Bloom filters derive their indices from (BloomFilter.indices_many)
+#   the murmur hashes of the txid's short ID under the first IBLT hash seeds, reduced to cell indices per table
+#   the leading bytes of the short ID's SHA256, the IBLT key sum hash
+# The hashes are the ones the filters and tables already use, so peers needn't fingerprint alike
+# Rows are kept in the order transactions were added to the txpool, so while the pool has only grown its rows
+# are a slice of the matrix and filtering it needs no per transaction lookups. Rows of other sets are looked up by txid
+# Like the txpool, which never evicts, fingerprints are never dropped, about 48 bytes and an index entry per transaction
+
+BLOOM_SIZE = 16
+KEY_SUM_SIZE = 8
+
+class Fingerprints:
+    def __init__(self, key_size=8, n_hashes=6):
+        # key_size: short ID length, the ID encoding truncates txids to it
+        # n_hashes: IBLT hash functions covered, tables with more hash keys themselves
+        self.key_size = key_size
+        self.n_hashes = n_hashes
+        self.width = BLOOM_SIZE + 4 * n_hashes + KEY_SUM_SIZE
+
+        # Rows in txpool order, the first count are used, and the row of each txid
+        self.matrix = np.zeros((0, self.width), dtype=np.uint8)
+        self.count = 0
+        self.index = {}
+
+    def __len__(self):
+        return self.count
+
+    def compute(self, tx_ids):
+        keys = bt.to_matrix([tx_id[:self.key_size] for tx_id in tx_ids], self.key_size)
+        bloom = np.frombuffer(b''.join([mmh3.hash_bytes(tx_id) for tx_id in tx_ids]), dtype=np.uint8)
+        cells = np.stack([bt.murmur3_32_signed(keys, i) for i in range(self.n_hashes)], axis=1).astype('<i4')
+        key_sums = np.frombuffer(b''.join(hl.sha256(key).digest()[:KEY_SUM_SIZE] for key in keys), dtype=np.uint8)
+        return np.concatenate([bloom.reshape(-1, BLOOM_SIZE), cells.view(np.uint8).reshape(-1, 4 * self.n_hashes),
+                               key_sums.reshape(-1, KEY_SUM_SIZE)], axis=1)
+
+    def add(self, tx_ids):
+        # Fingerprint transactions new to the txpool, in the order they were added to it
+        if len(tx_ids) == 0:
+            return
+        end = self.count + len(tx_ids)
+        if end > len(self.matrix):
+            grown = np.zeros((max(2 * len(self.matrix), end), self.width), dtype=np.uint8)
+            grown[:self.count] = self.matrix[:self.count]
+            self.matrix = grown
+        self.matrix[self.count:end] = self.compute(tx_ids)
+        self.index.update(zip(tx_ids, range(self.count, end)))
+        self.count = end
+
+    def pool_rows(self, tx_ids):
+        # Rows of the whole txpool given its txids in txpool order
+        # The leading rows if every fingerprinted transaction is still in the pool, looked up by txid otherwise
+        if len(tx_ids) == self.count:
+            return self.matrix[:self.count]
+        return self.rows(tx_ids)
+
+    def rows(self, tx_ids):
+        # Rows of txpool transactions in the given order
+        return self.matrix[[self.index[tx_id] for tx_id in tx_ids]]
+
+    def bloom_digests(self, rows):
+        # Murmur digests as BloomFilter.indices_many takes them, two 64 bit halves per row
+        return np.ascontiguousarray(rows[:, :BLOOM_SIZE]).view('<u8')
+
+    def iblt_hashes(self, rows, iblt):
+        # Cell hashes and key sum hashes for ArraySIBLT.encode of the rows' short IDs, each None if the table
+        # hashes keys in a way the fingerprints don't cover
+        if iblt.key_size != self.key_size:
+            return None, None
+        cell_hashes = None
+        if iblt.seed == 0 and iblt.n_hash_functions <= self.n_hashes:
+            cells = np.ascontiguousarray(rows[:, BLOOM_SIZE:BLOOM_SIZE + 4 * iblt.n_hash_functions])
+            cell_hashes = cells.view('<i4').astype(np.int64)
+        key_sum_hashes = None
+        if iblt.key_sum_size <= KEY_SUM_SIZE:
+            start = BLOOM_SIZE + 4 * self.n_hashes
+            key_sum_hashes = rows[:, start:start + iblt.key_sum_size]
+        return cell_hashes, key_sum_hashes
@@ -1,6 +1,8 @@
 import mmh3
 import byte_tools as bt
 import hashlib as hl
+import numpy as np
+import struct
 
 # Slim Invertible Bloom Lookup Table
 # Barebones implemenation of IBLT with values removed
@@ -92,4 +94,296 @@ class SIBLT:
         iblt = cls(n_cells, key_size, key_sum_size) # TODO: Assuming n_hash_funcs is default
         iblt.T = T
 
-        return iblt
\ No newline at end of file
+        return iblt
+
+# Array backed Slim Invertible Bloom Lookup Table
+# Counts are held in an int array, key sums and key sum hashes in uint8 matrices
+# Cell layout, hashing and serialisation agree with SIBLT so either may be used by a peer
+# A non zero seed selects a different family of cell hashes, tables over the same keys with different seeds
+# are extensions of each other and are peeled together by decode_tables
+# A partitioned table gives each hash function its own run of cells, so the cells of a key are always distinct.
+# Otherwise a key hashed twice to one cell leaves a count of 2 there with its key sum cancelled, and a key
+# sharing that cell looks pure with the wrong sign
+
+class ArraySIBLT:
+    def __init__(self, n_cells, key_size, key_sum_size, n_hash_functions=4, seed=0, partitioned=False):
+        self.n_cells = n_cells
+        self.n_hash_functions = n_hash_functions
+        self.key_size = key_size
+        self.key_sum_size = key_sum_size
+        self.seed = seed
+        self.partitioned = partitioned
+        if partitioned:
+            assert n_cells >= n_hash_functions, 'Fewer cells than hash functions'
+        self.counts = np.zeros(n_cells, dtype=np.int64)
+        self.key_sums = np.zeros((n_cells, key_size), dtype=np.uint8)
+        self.key_sum_hashes = np.zeros((n_cells, key_sum_size), dtype=np.uint8)
+
+    def hash_seed(self, i):
+        # Murmur seed of the i-th cell hash, seed 0 gives the SIBLT hashes
+        return (self.seed << 8) + i
+
+    def partition(self, i):
+        # First cell and cell count of the run of the i-th hash function
+        if not self.partitioned:
+            return 0, self.n_cells
+        start = i * self.n_cells // self.n_hash_functions
+        return start, (i + 1) * self.n_cells // self.n_hash_functions - start
+
+    def hash(self, i, key):
+        start, size = self.partition(i)
+        return start + mmh3.hash(key, self.hash_seed(i)) % size
+
+    def key_sum_hash(self, key):
+        return hl.sha256(key).digest()[:self.key_sum_size]
+
+    def indices(self, key_matrix, cell_hashes=None):
+        # Cell indices of each key, one row per key and one column per hash function
+        # cell_hashes: the keys' murmur hashes under each hash seed, if already known (see fingerprint.py)
+        columns = []
+        for i in range(self.n_hash_functions):
+            start, size = self.partition(i)
+            h = cell_hashes[:, i] if cell_hashes is not None else bt.murmur3_32_signed(key_matrix, self.hash_seed(i))
+            columns.append(start + h % size)
+        return np.stack(columns, axis=1)
+
+    def key_sum_hashes_of(self, key_matrix):
+        digests = b''.join(hl.sha256(key).digest()[:self.key_sum_size] for key in key_matrix)
+        return np.frombuffer(digests, dtype=np.uint8).reshape(-1, self.key_sum_size)
+
+    def toggle(self, key_matrix, signs, cell_hashes=None, key_sum_hashes=None):
+        # Add (sign 1) or remove (sign -1) a batch of keys from the table
+        # cell_hashes and key_sum_hashes may be given if already known, see indices
+        if len(key_matrix) == 0:
+            return
+        self.make_writable()
+        if key_sum_hashes is None:
+            key_sum_hashes = self.key_sum_hashes_of(key_matrix)
+        indices = self.indices(key_matrix, cell_hashes).ravel()
+        np.add.at(self.counts, indices, np.repeat(signs, self.n_hash_functions))
+        np.bitwise_xor.at(self.key_sums, indices, np.repeat(key_matrix, self.n_hash_functions, axis=0))
+        np.bitwise_xor.at(self.key_sum_hashes, indices, np.repeat(key_sum_hashes, self.n_hash_functions, axis=0))
+
+    def encode(self, keys, cell_hashes=None, key_sum_hashes=None):
+        key_matrix = bt.to_matrix(keys, self.key_size)
+        self.toggle(key_matrix, np.ones(len(key_matrix), dtype=np.int64), cell_hashes, key_sum_hashes)
+
+    def subtract(self, other):
+        if not isinstance(other, ArraySIBLT):
+            other = ArraySIBLT.from_siblt(other)
+        assert self.same_layout(other), 'Tables hash keys differently'
+        # Not in place, the columns of a deserialised table may be read only views of the message
+        self.counts = self.counts - other.counts
+        self.key_sums = self.key_sums ^ other.key_sums
+        self.key_sum_hashes = self.key_sum_hashes ^ other.key_sum_hashes
+
+    def same_layout(self, other):
+        return (self.n_cells, self.n_hash_functions, self.seed, self.partitioned) == \
+               (other.n_cells, other.n_hash_functions, other.seed, other.partitioned)
+
+    def add(self, other):
+        # Cell wise sum, the table of a union of disjoint key sets is the sum of their tables
+        assert self.same_layout(other), 'Tables hash keys differently'
+        self.counts = self.counts + other.counts
+        self.key_sums = self.key_sums ^ other.key_sums
+        self.key_sum_hashes = self.key_sum_hashes ^ other.key_sum_hashes
+
+    def copy(self):
+        iblt = ArraySIBLT(self.n_cells, self.key_size, self.key_sum_size, self.n_hash_functions, self.seed, self.partitioned)
+        iblt.counts = self.counts.copy()
+        iblt.key_sums = self.key_sums.copy()
+        iblt.key_sum_hashes = self.key_sum_hashes.copy()
+        return iblt
+
+    def make_writable(self):
+        # Copy any column still backed by a received buffer
+        if not self.key_sums.flags.writeable:
+            self.key_sums = self.key_sums.copy()
+        if not self.key_sum_hashes.flags.writeable:
+            self.key_sum_hashes = self.key_sum_hashes.copy()
+
+    def get_pure(self):
+        candidates = np.flatnonzero(np.abs(self.counts) == 1)
+        if len(candidates) == 0:
+            return candidates
+        hashes = self.key_sum_hashes_of(self.key_sums[candidates])
+        return candidates[(hashes == self.key_sum_hashes[candidates]).all(axis=1)]
+
+    def decode(self):
+        return decode_tables([self])
+
+    def _cell_ints(self, matrix):
+        width = matrix.shape[1]
+        b = matrix.tobytes()
+        return [int.from_bytes(b[i:i + width], 'big') for i in range(0, len(b), width)]
+
+    def _cell_matrix(self, ints, width):
+        b = b''.join(x.to_bytes(width, 'big') for x in ints)
+        return bt.to_matrix([b], width).copy()
+
+    def is_empty(self):
+        return not (self.counts.any() or self.key_sums.any() or self.key_sum_hashes.any())
+
+    @property
+    def T(self):
+        # Per cell view in the SIBLT layout
+        return [[int(c), k.tobytes(), h.tobytes()] for c, k, h in zip(self.counts, self.key_sums, self.key_sum_hashes)]
+
+    # Binary layout, version 1
+    #   header: magic, version, flags (reserved), cell count, key size, key sum size, hash count, packed counts length
+    #   counts: zig-zag varints, one per cell
+    #   key sums: n_cells * key_size bytes, row per cell
+    #   key sum hashes: n_cells * key_sum_size bytes, row per cell
+    # Version 2 appends the hash seed to the header and sets FLAG_PARTITIONED for partitioned tables,
+    # it is only written for tables not laid out as a SIBLT
+    MAGIC = b'IB'
+    VERSION = 2
+    HEADER = struct.Struct('>2sBBIBBBI')
+    SEED = struct.Struct('>I')
+    FLAG_PARTITIONED = 1
+
+    def is_plain(self):
+        # Laid out as a SIBLT
+        return self.seed == 0 and not self.partitioned
+
+    def serialise(self):
+        counts_b = bt.pack_varints(bt.zigzag_encode(self.counts))
+        version = 1 if self.is_plain() else 2
+        flags = self.FLAG_PARTITIONED if self.partitioned else 0
+        header = self.HEADER.pack(self.MAGIC, version, flags, self.n_cells, self.key_size,
+                                  self.key_sum_size, self.n_hash_functions, len(counts_b))
+        if version >= 2:
+            header += self.SEED.pack(self.seed)
+        return b''.join([header, counts_b, self.key_sums.tobytes(), self.key_sum_hashes.tobytes()])
+
+    def serialise_msgpack(self):
+        # SIBLT wire format, for peers which do not read the binary layout
+        assert self.is_plain(), 'Only plain tables have a SIBLT layout'
+        import msgpack
+        b = msgpack.packb(self.T)
+        return b
+
+    @classmethod
+    def from_table(cls, T, n_hash_functions=4):
+        n_cells = len(T)
+        key_size = len(T[0][1])
+        key_sum_size = len(T[0][2])
+        iblt = cls(n_cells, key_size, key_sum_size, n_hash_functions)
+        iblt.counts = np.array([cell[0] for cell in T], dtype=np.int64)
+        iblt.key_sums = bt.to_matrix([cell[1] for cell in T], key_size).copy()
+        iblt.key_sum_hashes = bt.to_matrix([cell[2] for cell in T], key_sum_size).copy()
+        return iblt
+
+    @classmethod
+    def from_siblt(cls, iblt):
+        return cls.from_table(iblt.T, iblt.n_hash_functions)
+
+    def to_siblt(self):
+        assert self.is_plain(), 'Only plain tables have a SIBLT layout'
+        iblt = SIBLT(self.n_cells, self.key_size, self.key_sum_size, self.n_hash_functions)
+        iblt.T = self.T
+        return iblt
+
+    @classmethod
+    def deserialise(cls, b):
+        if bytes(b[:2]) != cls.MAGIC:
+            import msgpack
+            T = msgpack.unpackb(b)
+            return cls.from_table(T) # TODO: Assuming n_hash_funcs is default
+
+        magic, version, flags, n_cells, key_size, key_sum_size, n_hash_functions, counts_len = cls.HEADER.unpack_from(b)
+        assert 1 <= version <= cls.VERSION, 'Unknown IBLT version %d' % version
+        offset = cls.HEADER.size
+        seed = 0
+        if version >= 2:
+            seed, = cls.SEED.unpack_from(b, offset)
+            offset += cls.SEED.size
+        iblt = cls(n_cells, key_size, key_sum_size, n_hash_functions, seed, bool(flags & cls.FLAG_PARTITIONED))
+
+        # Key columns are views of the received buffer, they are only copied if written to
+        counts, _ = bt.unpack_varints(b, n_cells, offset)
+        iblt.counts = bt.zigzag_decode(counts)
+        offset += counts_len
+        iblt.key_sums = np.frombuffer(b, dtype=np.uint8, count=n_cells * key_size, offset=offset).reshape(n_cells, key_size)
+        offset += n_cells * key_size
+        iblt.key_sum_hashes = np.frombuffer(b, dtype=np.uint8, count=n_cells * key_sum_size, offset=offset).reshape(n_cells, key_sum_size)
+
+        return iblt
+
+def decode_tables(tables, stats=None):
+    # Peel pure cells from a worklist, only the cells touched by a peel are rechecked
+    # Cells are worked on as python ints, XOR of ints is far cheaper than of numpy rows
+    # Every table holds the same key set difference, a key peeled from any table is removed from all of them
+    # stats, if given, is filled with the number of worklist entries checked and keys peeled
+    # A key may be checked in several cells and is removed from every table, its hashes are computed once
+    key_size = tables[0].key_size
+    cells = []
+    n_non_empty = 0
+    pure_list = []
+    for t, table in enumerate(tables):
+        assert table.key_size == key_size and table.key_sum_size == tables[0].key_sum_size, 'Tables of different keys'
+        counts = table.counts.tolist()
+        key_sums = table._cell_ints(table.key_sums)
+        key_sum_hashes = table._cell_ints(table.key_sum_hashes)
+        cells.append((counts, key_sums, key_sum_hashes))
+        n_non_empty += sum(1 for c, k, h in zip(counts, key_sums, key_sum_hashes) if c or k or h)
+        pure_list.extend((t, i) for i, c in enumerate(counts) if c == 1 or c == -1)
+
+    # Key sum hash and cells in each table of each key checked
+    key_sum_hashes_of = {}
+    cells_of = {}
+
+    a_minus_b = []
+    b_minus_a = []
+    n_checked = 0
+    while len(pure_list) > 0:
+        t, i = pure_list.pop()
+        n_checked += 1
+        counts, key_sums, key_sum_hashes = cells[t]
+        c = counts[i]
+        if c != 1 and c != -1:
+            continue
+
+        s = key_sums[i].to_bytes(key_size, 'big')
+        h = key_sum_hashes_of.get(s)
+        if h is None:
+            h = key_sum_hashes_of[s] = int.from_bytes(tables[t].key_sum_hash(s), 'big')
+        if h != key_sum_hashes[i]:
+            continue
+        key_cells = cells_of.get(s)
+        if key_cells is None:
+            key_cells = cells_of[s] = [[table.hash(j, s) for j in range(table.n_hash_functions)] for table in tables]
+        if i not in key_cells[t]:
+            continue
+
+        if c > 0:
+            a_minus_b.append(s)
+        else:
+            b_minus_a.append(s)
+
+        k = key_sums[i]
+        for u, table in enumerate(tables):
+            counts, key_sums, key_sum_hashes = cells[u]
+            for j in key_cells[u]:
+                was_empty = not (counts[j] or key_sums[j] or key_sum_hashes[j])
+                counts[j] -= c
+                key_sums[j] ^= k
+                key_sum_hashes[j] ^= h
+                is_empty = not (counts[j] or key_sums[j] or key_sum_hashes[j])
+                n_non_empty += was_empty - is_empty
+                if counts[j] == 1 or counts[j] == -1:
+                    pure_list.append((u, j))
+
+    for table, (counts, key_sums, key_sum_hashes) in zip(tables, cells):
+        table.counts = np.array(counts, dtype=np.int64)
+        table.key_sums = table._cell_matrix(key_sums, table.key_size)
+        table.key_sum_hashes = table._cell_matrix(key_sum_hashes, table.key_sum_size)
+
+    if stats is not None:
+        stats['checked'] = n_checked
+        stats['peels'] = len(a_minus_b) + len(b_minus_a)
+
+    if n_non_empty == 0:
+        return 'Success', a_minus_b, b_minus_a
+    else:
+        return 'Fail', a_minus_b, b_minus_a
@@ -1,31 +1,108 @@
 import byte_tools
+import numpy as np
+
+# Partial Merkle tree held as flat arrays
+# The top nodes are one (n, 32) matrix of hashes and the leafs another, in the order they were given
+# Each top node covers a fixed size run of leaf slots, slots holds the index of the leaf in each slot
+# (-1 for null padding), so permuting top nodes only permutes rows of two arrays
+# Levels above the top nodes are cached once the root has been asked for, top nodes moved since are
+# marked dirty and only the paths above them are rehashed on the next root check or climb
+
+HASH_SIZE = 32
+NULL_SLOT = -1
+
+def hash_pairs(nodes):
+    # Hash consecutive pairs of rows of an (n, 32) matrix into an (n / 2, 32) matrix
+    b = nodes.tobytes()
+    digests = b''.join([byte_tools.sha256(b[i:i + 2 * HASH_SIZE]) for i in range(0, len(b), 2 * HASH_SIZE)])
+    return byte_tools.to_matrix([digests], HASH_SIZE)
+
+def null_nodes(n):
+    return np.tile(np.frombuffer(byte_tools.empty_hash, dtype=np.uint8), (n, 1))
 
 class PartialMerkleTree:
-    def __init__(self, top_nodes):
+    def __init__(self, top_nodes, leafs=None, slots=None):
         self.top_nodes = top_nodes
+        self.leafs = leafs if leafs is not None else np.zeros((0, HASH_SIZE), dtype=np.uint8)
+        self.slots = slots if slots is not None else np.full(len(top_nodes), NULL_SLOT, dtype=np.int64)
+
+        # Cached levels above the top nodes, up to the root, and the top node positions changed since
+        self.upper = None
+        self.dirty = set()
 
     @classmethod
     def from_leaf_values(cls, leaf_values):
-        leaf_nodes = [MerkleNode.from_leaf_value(leaf) for leaf in leaf_values]
-        if len(leaf_values) % 2 == 1:
-            leaf_nodes.append(MerkleNode.null())
-        return cls(leaf_nodes)
+        # Leaf values may be any iterable of hashes, such as a ProtoBlock
+        leafs = byte_tools.to_matrix(leaf_values, HASH_SIZE)
+        slots = np.arange(len(leafs), dtype=np.int64)
+        tree = cls(leafs, leafs, slots)
+        tree.make_even()
+        return tree
+
+    def make_even(self):
+        # Pad the top nodes with a null node if odd
+        if len(self.top_nodes) % 2 == 1:
+            width = len(self.slots) // len(self.top_nodes)
+            self.top_nodes = np.concatenate([self.top_nodes, null_nodes(1)])
+            self.slots = np.concatenate([self.slots, np.full(width, NULL_SLOT, dtype=np.int64)])
 
     def add_merkle_level(self):
         # Construct height above in the Merkle Tree
 
         # Make current height even
-        if len(self.top_nodes) % 2 == 1:
-            self.top_nodes.append(MerkleNode.null())
+        self.make_even()
 
-        top_nodes = self.top_nodes
-        self.top_nodes = [MerkleNode(top_nodes[2 * i], top_nodes[2 * i + 1]) for i in range(int(len(self.top_nodes) / 2))]
+        if self.upper is not None:
+            # Climb onto the cached level above
+            self.update_upper()
+            self.top_nodes = self.upper.pop(0)
+        else:
+            self.top_nodes = hash_pairs(self.top_nodes)
 
     def get_top_values(self):
-        return [node.value for node in self.top_nodes]
+        b = self.top_nodes.tobytes()
+        return [b[i:i + HASH_SIZE] for i in range(0, len(b), HASH_SIZE)]
+
+    def permute(self, order):
+        # Reorder the top nodes, together with the leaf slots below them, by an index array
+        order = np.asarray(order, dtype=np.int64)
+        if len(order) != len(self.top_nodes):
+            # The levels above change shape, drop the cache
+            self.upper = None
+        elif self.upper is not None:
+            self.dirty.update(np.flatnonzero(order != np.arange(len(order))).tolist())
+        self.slots = self.slots.reshape(len(self.top_nodes), -1)[order].ravel()
+        self.top_nodes = self.top_nodes[order]
+
+    def remove_leafs(self, values):
+        # Remove leafs from a tree still at the leafs, leafs after the first removed one move down
+        # Null padding is dropped too, as when rebuilding the tree from get_leafs, and added again at the end if odd
+        # Cached levels are cut to their new sizes and only the paths from the first moved node on are rehashed,
+        # or from the last node if only the last ones were removed, whose parents lost their right children
+        assert len(self.slots) == len(self.top_nodes), 'Leafs can only be removed at height 0'
+        rows = self.top_nodes.view('V%d' % HASH_SIZE).ravel()
+        keep = ~np.isin(rows, byte_tools.to_matrix(values, HASH_SIZE).view('V%d' % HASH_SIZE).ravel())
+        keep &= self.slots != NULL_SLOT
+        first = int(np.argmin(keep)) if not keep.all() else len(keep)
+        self.top_nodes = self.top_nodes[keep]
+        self.slots = self.slots[keep]
+        self.make_even()
+
+        if self.upper is not None:
+            levels = []
+            size = len(self.top_nodes)
+            for level in self.upper:
+                if size <= 1:
+                    break
+                size = (size + 1) // 2
+                levels.append(level[:size])
+            self.upper = levels if levels else None
+            if not keep.all():
+                first = min(first, len(self.top_nodes) - 1)
+            self.dirty = set(i for i in self.dirty if i < first) | set(range(first, len(self.top_nodes)))
 
     def rotate(self):
-        self.top_nodes = self.top_nodes[-1:] + self.top_nodes[:-1]
+        self.permute(np.roll(np.arange(len(self.top_nodes)), 1))
 
     def get_top_value_pairs(self):
         # Get the pairs of consecutive values of the top nodes
@@ -35,10 +112,43 @@ class PartialMerkleTree:
 
     def get_leafs(self):
         # Get the values of all leaf nodes
-        leafs = []
-        for node in self.top_nodes:
-            leafs.extend(node.get_leaf_values())
-        return leafs
+        b = self.leafs[self.slots[self.slots != NULL_SLOT]].tobytes()
+        return [b[i:i + HASH_SIZE] for i in range(0, len(b), HASH_SIZE)]
+
+    def get_root(self):
+        # Root of the tree above the top nodes, rehashing only the paths above dirty top nodes
+        if len(self.top_nodes) == 1:
+            return self.top_nodes[0].tobytes()
+        if self.upper is None:
+            self.upper = []
+            level = self.top_nodes
+            while len(level) > 1:
+                level = hash_pairs(self.pad(level)).copy()
+                self.upper.append(level)
+            self.dirty = set()
+        else:
+            self.update_upper()
+        return self.upper[-1][0].tobytes()
+
+    def pad(self, level):
+        if len(level) % 2 == 1:
+            return np.concatenate([level, null_nodes(1)])
+        return level
+
+    def update_upper(self):
+        # Rehash the cached levels above the dirty top nodes
+        # The dirty nodes of a level are hashed in one pass, so a long dirty tail costs about a rebuild of it
+        dirty = np.array(sorted(self.dirty), dtype=np.int64)
+        below = self.top_nodes
+        for level in self.upper:
+            if len(dirty) == 0:
+                break
+            dirty = dirty // 2
+            dirty = dirty[np.concatenate([[True], dirty[1:] != dirty[:-1]])]
+            children = np.stack([2 * dirty, 2 * dirty + 1], axis=1).ravel()
+            level[dirty] = hash_pairs(self.pad(below)[children])
+            below = level
+        self.dirty = set()
 
     def make_tree(self):
         # Construct entire tree
@@ -47,78 +157,40 @@ class PartialMerkleTree:
 
     def reconcile_order(self, missing_pairs):
         # Reconcile order given missing pairs
-        # TODO: Make faster and more succinct
+        # Works on positions of the top values, found through a value -> position dict, so a round is O(n + k)
         # TODO: Analysis using involutions/cycles in group theory might help here
 
-        top_pairs = self.get_top_value_pairs()
         top_values = self.get_top_values()
-        new_top_pairs = self.get_top_value_pairs()
+        n_pairs = len(top_values) // 2
+
+        # Position of the first occurrence of each value, and of each consecutive pair
+        positions = {}
+        for i, v in enumerate(top_values):
+            positions.setdefault(v, i)
+        first = np.array([positions[v] for v in top_values], dtype=np.int64)
+        pair_positions = {}
+        for i, pair in enumerate(zip(top_values[:2 * n_pairs:2], top_values[1:2 * n_pairs:2])):
+            pair_positions.setdefault(pair, i)
 
         # Find values that are out of order
-        excess_values = []
+        excess_values = set()
         for missing_pair in missing_pairs:
-            excess_values.append(missing_pair[0])
-            excess_values.append(missing_pair[1])
+            excess_values.add(missing_pair[0])
+            excess_values.add(missing_pair[1])
 
         # Find pairs that are erroneous
-        excess_pairs = []
-        for pair in top_pairs:
-            if pair[0] in excess_values or pair[1] in excess_values:
-                excess_pairs.append(pair)
+        is_excess = np.array([v in excess_values for v in top_values[:2 * n_pairs]], dtype=bool).reshape(-1, 2)
+        excess_pairs = np.flatnonzero(is_excess.any(axis=1))
 
-        # Replace error pairs with missing pairs
+        # Replace error pairs with missing pairs, pairs are held as the positions of their values
+        new_top_pairs = first[:2 * n_pairs].reshape(-1, 2).copy()
         for i, missing_pair in enumerate(missing_pairs):
-            new_top_pairs[top_pairs.index(excess_pairs[i])] = missing_pair
-
-        # Reorder pairs into sensible order
-        # TODO: Make this more succinct remodeling this entire procedure
-        def new_sort(pair):
-            return top_values.index(pair[1])
-
-
-        new_top_pairs.sort(key=new_sort)
+            j = excess_pairs[i]
+            excess_pair = (top_values[2 * j], top_values[2 * j + 1])
+            new_top_pairs[pair_positions[excess_pair]] = (positions[missing_pair[0]], positions[missing_pair[1]])
 
-        # Recalculate top values by expanding new top pairs
-        expand = []
-        for pair in new_top_pairs:
-            expand.append(pair[0])
-            expand.append(pair[1])
-
-        new_order = [top_values.index(v) for v in expand]
+        # Reorder pairs by the position of their second value
+        new_top_pairs = new_top_pairs[np.argsort(new_top_pairs[:, 1], kind='stable')]
 
         # Permute top nodes based on the new order
-        self.top_nodes = [self.top_nodes[i] for i in new_order]
-
-
-class MerkleNode:
-    def __init__(self, left, right, value=None):
-        if value is None:
-            self.value = byte_tools.sha256(left.value + right.value)
-        else:
-            self.value = value
-        self.left = left
-        self.right = right
-
-    def is_null(self):
-        return (self.value == byte_tools.empty_hash)
-
-    def is_leaf(self):
-        return ((self.left == None) & (not self.is_null()))
-
-    @classmethod
-    def from_leaf_value(cls, leaf):
-        return cls(None, None, leaf)
-
-    @classmethod
-    def null(cls):
-        return cls(None, None, byte_tools.empty_hash)
-
-    def get_leaf_values(self):
-        if self.is_null():
-            # TODO: Is this necessary?
-            return []
-
-        if self.is_leaf():
-            return [self.value]
-
-        return self.left.get_leaf_values() + self.right.get_leaf_values()
\ No newline at end of file
+        self.permute(new_top_pairs.ravel())
@@ -0,0 +1,80 @@
+import byte_tools as bt
+import numpy as np
+from itertools import accumulate
+
+# Binary codecs for the GET_GLBLKDAT and GLBLKTX payloads
+#
+# GET_GLBLKDAT: the short IDs missing from the receivers protoblock
+#   1 byte   short ID width w
+#   n * w    short IDs back to back, n is implied by the payload length
+#
+# GLBLKTX: the missing transactions grouped into segments of consecutive transactions (see Node.missing_response)
+# Held in columns so each decodes in one pass
+#   1 byte   short ID width w
+#   varint   segment count s
+#   s bytes  per segment, 0 if it precedes the transaction with the following short ID, 1 if it ends the block
+#   w bytes  per segment not ending the block, the short ID of the next transaction
+#   s varints   transaction count of each segment
+#   varints     length of every transaction, in segment order
+#   the transaction bytes back to back
+
+END_OF_BLOCK = b'\x00'
+
+def encode_missing_ids(short_ids):
+    if len(short_ids) == 0:
+        return b'\x00'
+    width = len(short_ids[0])
+    return bytes([width]) + b''.join(short_ids)
+
+def decode_missing_ids(buf):
+    width = buf[0]
+    if width == 0:
+        return []
+    # One reshape into rows, read back as one bytes object per row
+    return bt.to_matrix([bytes(buf[1:])], width).view('V%d' % width).ravel().tolist()
+
+def encode_missing_txs(segments):
+    width = next((len(next_id) for next_id, txs in segments if next_id != END_OF_BLOCK), 0)
+    flags = bytes([next_id == END_OF_BLOCK for next_id, txs in segments])
+    next_ids = [next_id for next_id in (segment[0] for segment in segments) if next_id != END_OF_BLOCK]
+    assert all(len(next_id) == width for next_id in next_ids), 'Segment labels must be short IDs!'
+    txs_b = [tx if isinstance(tx, bytes) else tx.encode() for next_id, txs in segments for tx in txs]
+    return b''.join([bytes([width]), bt.varint(len(segments)), flags, b''.join(next_ids),
+                     bt.pack_varints([len(txs) for next_id, txs in segments]),
+                     bt.pack_varints([len(tx_b) for tx_b in txs_b]), b''.join(txs_b)])
+
+def decode_missing_txs(buf):
+    # Columns are read whole, transactions are cut from the body by their cumulative lengths and grouped
+    # into segments by their cumulative counts
+    buf = memoryview(buf)
+    width = buf[0]
+    n_segments, offset = bt.read_varint(buf, 1)
+    flags = np.frombuffer(buf, dtype=np.uint8, count=n_segments, offset=offset)
+    offset += n_segments
+    n_labelled = n_segments - int(flags.sum())
+    next_ids = decode_missing_ids(bytes([width]) + bytes(buf[offset:offset + n_labelled * width]))
+    offset += n_labelled * width
+    for i in np.flatnonzero(flags).tolist():
+        next_ids.insert(i, END_OF_BLOCK)
+
+    # A varint is at most 10 bytes, only that much of the buffer is scanned for each column
+    counts, n = bt.unpack_varints(buf[offset:offset + 10 * n_segments], n_segments)
+    offset += n
+    counts = counts.tolist()
+    n_txs = sum(counts)
+    lengths, n = bt.unpack_varints(buf[offset:offset + 10 * n_txs], n_txs)
+    offset += n
+    ends = list(accumulate(lengths.tolist()))
+
+    # Transactions are hex, so the body decodes once and character offsets are byte offsets
+    body = buf[offset:]
+    try:
+        body = str(body, 'ascii')
+    except UnicodeDecodeError:
+        body = bytes(body)
+    txs = [body[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    if isinstance(body, bytes):
+        txs = [str(tx, 'utf-8') for tx in txs]
+
+    segment_ends = list(accumulate(counts))
+    return [(next_id, txs[start:end]) for next_id, start, end in zip(next_ids, [0] + segment_ends[:-1], segment_ends)]
@@ -1,10 +1,12 @@
-import _pickle as cpickle
-import socket
-import threading
+import asyncio
+import json
+import msg_codec
 import time
-from iblt_slim import SIBLT
+from collections import Counter, namedtuple
+from iblt_slim import ArraySIBLT
 from bloom import BloomFilter
 from enum import Enum
+from transport import TcpTransport
 
 class NetworkMsg(Enum):
     INV=0
@@ -14,287 +16,344 @@ class NetworkMsg(Enum):
     GLBLKTX=4
     GLBLKORD=5
     COMPLETE=6
-
-
-class NodeServer:
-    def __init__(self, ip, port):
-        # Network Parameters
-        self.ip = ip
-        self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_sock = None
+    GET_GLBLKEXT=7
+    GLBLKEXT=8
+    GLBLKORDACK=9
+
+# Phases an IBLT extension may be asked for in
+EXT_TX_PHASE = 0
+EXT_ORDER_PHASE = 1
+
+# Field layout of each message following its type byte
+# An int is a fixed length field, None a field prefixed by its 3 byte length
+# TODO: Don't send length for fixed length types
+MSG_FIELDS = {
+    NetworkMsg.INV: [32],
+    NetworkMsg.GET_GLBLK: [3],
+    NetworkMsg.GLBLK: [None, None],
+    NetworkMsg.GET_GLBLKDAT: [None],
+    NetworkMsg.GLBLKTX: [None],
+    NetworkMsg.GLBLKORD: [None, None, None],
+    NetworkMsg.COMPLETE: [None],
+    NetworkMsg.GET_GLBLKEXT: [1, 3, 1, 4, 1],
+    NetworkMsg.GLBLKEXT: [None],
+    NetworkMsg.GLBLKORDACK: [1],
+}
+
+# Messages whose decoded objects keep views of the received fields (see ArraySIBLT.deserialise)
+# Their fields are read into buffers of their own rather than the reader's reusable buffer
+RETAINED_MSGS = {NetworkMsg.GLBLK, NetworkMsg.GLBLKORD, NetworkMsg.GLBLKEXT}
+
+# Messages counted as recovery from IBLT decode failures
+EXT_MSGS = {NetworkMsg.GET_GLBLKEXT, NetworkMsg.GLBLKEXT}
+
+# Fields of GET_GLBLKEXT: phase, Merkle height (0 in the tx phase), seed, cell count and hash count of the extension
+ExtRequest = namedtuple('ExtRequest', ['phase', 'height', 'seed', 'n_cells', 'n_hashes'])
+
+def encode_message(typ, obj):
+    # Encode a message object into its fields
+    if typ == NetworkMsg.INV:
+        return [obj]
+    if typ == NetworkMsg.GET_GLBLK:
+        return [obj.to_bytes(3, 'big')]
+    if typ == NetworkMsg.GLBLKORDACK:
+        return [obj.to_bytes(1, 'big')]
+    if typ == NetworkMsg.GLBLK:
+        bloom, iblt = obj
+        return [bloom.serialise(), iblt.serialise()] # TODO: Better bloom serialization
+    if typ == NetworkMsg.GLBLKORD:
+        # The pair encoding's digest travels with the pair sketches
+        bloom, iblt, digest = obj
+        return [bloom.serialise(), iblt.serialise(), digest]
+    if typ == NetworkMsg.GET_GLBLKDAT:
+        return [msg_codec.encode_missing_ids(obj)]
+    if typ == NetworkMsg.GLBLKTX:
+        return [msg_codec.encode_missing_txs(obj)]
+    if typ == NetworkMsg.GET_GLBLKEXT:
+        return [value.to_bytes(length, 'big') for value, length in zip(obj, MSG_FIELDS[typ])]
+    if typ == NetworkMsg.GLBLKEXT:
+        return [obj.serialise()]
+    if typ == NetworkMsg.COMPLETE:
+        # Reconciliation analytics of the receiver, as JSON
+        return [json.dumps(obj).encode()]
+
+def decode_message(typ, fields):
+    # Decode the fields of a message into its object
+    if typ == NetworkMsg.INV:
+        return bytes(fields[0])
+    if typ == NetworkMsg.GET_GLBLK or typ == NetworkMsg.GLBLKORDACK:
+        return int.from_bytes(fields[0], 'big')
+    if typ == NetworkMsg.GLBLK:
+        return [BloomFilter.deserialise(fields[0]), ArraySIBLT.deserialise(fields[1])]
+    if typ == NetworkMsg.GLBLKORD:
+        return [BloomFilter.deserialise(fields[0]), ArraySIBLT.deserialise(fields[1]), bytes(fields[2])]
+    if typ == NetworkMsg.GET_GLBLKDAT:
+        return msg_codec.decode_missing_ids(fields[0])
+    if typ == NetworkMsg.GLBLKTX:
+        return msg_codec.decode_missing_txs(fields[0])
+    if typ == NetworkMsg.GET_GLBLKEXT:
+        return ExtRequest(*[int.from_bytes(field, 'big') for field in fields])
+    if typ == NetworkMsg.GLBLKEXT:
+        return ArraySIBLT.deserialise(fields[0])
+    if typ == NetworkMsg.COMPLETE:
+        return json.loads(bytes(fields[0]))
+
+def frame_message(typ, fields):
+    # Prefix the fields with the message type and the lengths of variable length fields
+    parts = [typ.value.to_bytes(1, 'big')]
+    for length, field in zip(MSG_FIELDS[typ], fields):
+        if length is None:
+            parts.append(len(field).to_bytes(3, 'big'))
+        else:
+            assert len(field) == length, 'Bad %s field length' % typ.name
+        parts.append(field)
+    return b''.join(parts)
+
+
+FrameTiming = namedtuple('FrameTiming', ['typ', 'n_bytes', 'seconds'])
+
+class FrameReader:
+    # Reads whole message frames from a transport stream with recv_into
+    # Fields are filled into a reusable buffer and handed out as memoryview slices,
+    # which stay valid until the next frame is read
+
+    def __init__(self, conn, buffer_size=1 << 16):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.offset = 0
+
+        # Receive timing of each frame, from its type byte to its last byte
+        self.frame_times = []
+
+    async def fill(self, view):
+        # Fill the view completely, recv may return less than asked for
+        filled = 0
+        while filled < len(view):
+            n = await self.conn.recv_into(view[filled:])
+            if n == 0:
+                raise ConnectionError('Connection closed mid message')
+            filled += n
+
+    async def read(self, n, retain=False):
+        if retain:
+            view = memoryview(bytearray(n))
+        else:
+            if self.offset + n > len(self.buffer):
+                # Grow by replacing, earlier fields of this frame keep the old buffer alive
+                self.buffer = bytearray(max(2 * len(self.buffer), n))
+                self.offset = 0
+            view = memoryview(self.buffer)[self.offset:self.offset + n]
+            self.offset += n
+        await self.fill(view)
+        return view
+
+    async def read_frame(self):
+        # Returns the message type and its fields, or None once the peer has closed the connection
+        self.offset = 0
+        view = memoryview(self.buffer)[:1]
+        if await self.conn.recv_into(view) == 0:
+            return None
+        start = time.perf_counter()
+        # First we're always going to get the NodeServerMsg data
+        typ = NetworkMsg(view[0])
+
+        retain = typ in RETAINED_MSGS
+        fields = []
+        for length in MSG_FIELDS[typ]:
+            if length is None:
+                length = int.from_bytes(await self.read(3), 'big')
+            fields.append(await self.read(length, retain))
+
+        n_bytes = sum(len(field) for field in fields)
+        self.frame_times.append(FrameTiming(typ, n_bytes, time.perf_counter() - start))
+        return typ, fields
+
+
+class PeerSession:
+    # One connection to a peer, used in both directions
+    # Holds the protocol state of that peer: received messages are decoded as soon as their frame
+    # arrives and fed to a queue per message type which the protocol awaits with wait_for
+    # Once the session has ended, waiting for a message not already received raises ConnectionError, as does
+    # sending on a closed connection
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.reader = FrameReader(conn)
+        self.handler_task = None
 
         # Analytics
         self.total_sent = 0
         self.total_received = 0
         self.total_ord_sent = 0
         self.total_ord_received = 0
-
-        # Cached values
-        self.tx_filters = None
-        self.merkle_root = None
-        self.tx_missing_ids = None
-        self.tx_missing = None
-        self.pair_filters = []
-        self.other_txpool_size = None
-        self.complete = None
+        # Bytes spent recovering from IBLT decode failures, extension requests and extensions
+        self.total_ext_sent = 0
+        self.total_ext_received = 0
+        # Bytes per message type
+        self.sent_by_type = Counter()
+        self.received_by_type = Counter()
+
+        # Received messages, created here so they belong to the running event loop
+        self.inbox = {typ: asyncio.Queue() for typ in NetworkMsg}
+        # Held for the whole of a frame's sendall, the order, extension and data sends of a relay run concurrently
+        # and sendall calls on one socket would interleave their bytes
+        self.send_lock = asyncio.Lock()
 
     def start(self):
-        threading.Thread(target=self.server_handler).start()
+        self.handler_task = asyncio.ensure_future(self.session_handler())
 
-    def connectTo(self, ip, port):
-        self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        while True:
-            try:
-                self.client_sock.connect((ip, port))
-                break
-            except socket.error:
-                pass
-
-    def send(self, typ, obj):
-        if self.client_sock is None:
-            print("Unable to send data -- not connected!")
-        else:
-            # Send type
-            # TODO: Don't send length for fixed length types
-            self.client_sock.send(typ.value.to_bytes(1, 'big'))
-            if typ == NetworkMsg.INV:
-                # Send message
-                print('Sending INV...')
-                self.client_sock.send(obj)
-
-                length = len(obj)
-                print('Sent INV of size %d bytes' % length)
-                self.total_sent += length
-            if typ == NetworkMsg.GET_GLBLK:
-                # Encode message
-                message = obj.to_bytes(3, 'big')
-
-                # Send message
-                length = len(message)
-                print('Sending GET_GLBLK...')
-                self.client_sock.send(message)
-                print('Sent GET_GLBLK of size %d bytes' % length)
-                self.total_sent += length
-            if typ == NetworkMsg.GLBLK:
-                # Encode message
-                bloom = obj[0]
-                iblt = obj[1]
-                iblt_b = iblt.serialise()
-                bloom_b = bloom.serialise()
-
-                print('Sending GLBLK...')
-                # Send Bloom Length
-                bloom_length = len(bloom_b)
-                self.client_sock.send(bloom_length.to_bytes(3, 'big'))
-
-                # Send bloom
-                self.client_sock.send(bloom_b)
-
-                # Send Bloom Length
-                iblt_length = len(iblt_b)
-                self.client_sock.send(iblt_length.to_bytes(3, 'big'))
-
-                # Send bloom
-                self.client_sock.send(iblt_b)
-                print('Sent GLBLK of size %d bytes' % (bloom_length + iblt_length))
-                self.total_sent += bloom_length + iblt_length
-            if typ == NetworkMsg.GET_GLBLKDAT:
-                # Encode message
-                message = bytes(cpickle.dumps(obj))
-
-                # Send message length
-                length = len(message)
-                self.client_sock.send(length.to_bytes(3, 'big'))
-
-                # Send message
-                print('Sending GET_GLBLKDAT...')
-                self.client_sock.send(message)
-                print('Sent GLBLKDAT of size %d bytes' % length)
-                self.total_sent += length
-            elif typ == NetworkMsg.GLBLKTX:
-                # Encode message
-                message = bytes(cpickle.dumps(obj))
-
-                # Send message length
-                length = len(message)
-                self.client_sock.send(length.to_bytes(3, 'big'))
-
-                # Send message
-                print('Sending GLBLKTX...')
-                self.client_sock.send(message)
-                print('Sent GLBLKTX of size %d bytes' % length)
-                self.total_sent += length
-            elif typ == NetworkMsg.GLBLKORD:
-                # Encode message
-                bloom = obj[0]
-                iblt = obj[1]
-                iblt_b = iblt.serialise()
-                bloom_b = bloom.serialise() # TODO: Better serialization
-
-                print('Sending GLBLKORD...')
-                # Send Bloom Length
-                bloom_length = len(bloom_b)
-                self.client_sock.send(bloom_length.to_bytes(3, 'big'))
-
-                # Send bloom
-                self.client_sock.send(bloom_b)
-
-                # Send IBLT Length
-                iblt_length = len(iblt_b)
-                self.client_sock.send(iblt_length.to_bytes(3, 'big'))
-
-                # Send bloom
-                self.client_sock.send(iblt_b)
-                print('Sent GLBLKORD of size %d bytes' % (bloom_length + iblt_length))
-                self.total_sent += bloom_length + iblt_length
-                self.total_ord_sent += bloom_length + iblt_length
-            elif typ == NetworkMsg.COMPLETE:
-                # Send reconciliation analytics
-                # TODO: Implement
-
-                # Create analytics
-                message = int(0).to_bytes(1,'big')
-
-                # Send analytics
-                self.client_sock.send(message)
-                self.total_sent += 1
-
-    def waitOn(self, typ):
-        if typ == NetworkMsg.INV:
-            print('Waiting for INV...')
-            while(self.merkle_root is None):
-                time.sleep(1)
-        elif typ == NetworkMsg.GET_GLBLK:
-            print('Waiting for GET_GLBLK...')
-            while(self.other_txpool_size is None):
-                time.sleep(1)
-        elif typ == NetworkMsg.GLBLK:
-            print('Waiting for GLBLK...')
-            while(self.tx_filters is None):
-                time.sleep(1)
-        elif typ == NetworkMsg.GET_GLBLKDAT:
-            print('Waiting for GET_GLBLKDAT...')
-            while(self.tx_missing_ids is None):
-                time.sleep(1)
-        elif typ == NetworkMsg.GLBLKTX:
-            print('Waiting for GLBLKTX...')
-            while(self.tx_missing is None):
-                time.sleep(1)
-        elif typ == NetworkMsg.GLBLKORD:
-            print('Waiting for GET_GLBLKORD...')
-            while(self.pair_filters == []):
-                time.sleep(1)
-
-    def server_handler(self):
-        self.sock.bind((self.ip, self.port))
-        self.sock.listen(1)
-        print("Starting server on %s : %d" % (self.ip, self.port))
+    async def send(self, typ, obj):
+        await self.send_encoded(typ, encode_message(typ, obj))
+
+    async def send_encoded(self, typ, fields):
+        # Send a message already encoded into its fields
+        length = sum(len(field) for field in fields)
 
+        async with self.send_lock:
+            print('Sending %s to %s...' % (typ.name, self.addr[0]))
+            try:
+                await self.conn.sendall(frame_message(typ, fields))
+            except OSError as e:
+                raise ConnectionError('Session with %s closed sending %s' % (self.addr[0], typ.name)) from e
+            print('Sent %s of size %d bytes' % (typ.name, length))
+
+        self.total_sent += length
+        self.sent_by_type[typ.name] += length
+        if typ == NetworkMsg.GLBLKORD:
+            self.total_ord_sent += length
+        if typ in EXT_MSGS:
+            self.total_ext_sent += length
+
+    def stats(self):
+        return {'sent': dict(self.sent_by_type), 'received': dict(self.received_by_type),
+                'ext_sent': self.total_ext_sent, 'ext_received': self.total_ext_received}
+
+    async def wait_for(self, typ):
+        # Wait for the next message of the given type and return its object
+        inbox = self.inbox[typ]
+        if not inbox.empty():
+            return inbox.get_nowait()
+        if self.handler_task.done():
+            raise ConnectionError('Session with %s closed waiting for %s' % (self.addr[0], typ.name))
+
+        print('Waiting for %s...' % typ.name)
+        get = asyncio.ensure_future(inbox.get())
+        try:
+            await asyncio.wait([get, self.handler_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not get.done():
+                get.cancel()
+        if not get.done() or get.cancelled():
+            raise ConnectionError('Session with %s closed waiting for %s' % (self.addr[0], typ.name))
+        return get.result()
+
+    def pending(self, typ):
+        # Number of received messages of the given type not yet waited on
+        return self.inbox[typ].qsize()
+
+    async def session_handler(self):
         try:
-            conn, addr = self.sock.accept()
-        except:
-            print("Server never received a connection...closing")
-            return
+            while True:
+                frame = await self.reader.read_frame()
+                if frame is None: break
+                typ, fields = frame
+
+                timing = self.reader.frame_times[-1]
+                print('Received %s of size %d bytes in %.4f s' % (typ.name, timing.n_bytes, timing.seconds))
+                self.total_received += timing.n_bytes
+                self.received_by_type[typ.name] += timing.n_bytes
+                if typ == NetworkMsg.GLBLKORD:
+                    self.total_ord_received += timing.n_bytes
+                if typ in EXT_MSGS:
+                    self.total_ext_received += timing.n_bytes
+                self.inbox[typ].put_nowait(decode_message(typ, fields))
+        except OSError:
+            pass
+
+        self.conn.close()
+
+    def close(self):
+        if self.handler_task is not None:
+            self.handler_task.cancel()
+        self.conn.close()
 
-        print("Connection from %s" % (addr[0]))
+
+class NodeServer:
+    # asyncio server accepting any number of peers, each gets its own PeerSession
+    # Connections go through a transport, TCP sockets by default (see transport.py)
+
+    def __init__(self, ip, port, backlog=128, transport=None):
+        # Network Parameters
+        self.ip = ip
+        self.port = port
+        self.backlog = backlog
+        self.transport = transport if transport is not None else TcpTransport()
+        self.listener = None
+        self.handler_task = None
+
+        # Sessions of accepted and opened connections
+        self.sessions = []
+        self.accepted = None
+
+    @property
+    def total_sent(self):
+        return sum(session.total_sent for session in self.sessions)
+
+    @property
+    def total_received(self):
+        return sum(session.total_received for session in self.sessions)
+
+    async def start(self):
+        self.accepted = asyncio.Queue()
+
+        self.listener = await self.transport.listen(self.ip, self.port, self.backlog)
+        print("Starting server on %s : %d" % (self.ip, self.port))
+        self.handler_task = asyncio.ensure_future(self.server_handler())
+
+    def add_session(self, conn, addr):
+        session = PeerSession(conn, addr)
+        session.start()
+        self.sessions.append(session)
+        return session
+
+    async def connect_to(self, ip, port, retry_interval=0.1, max_retry_interval=2, timeout=None):
+        # Open a session to a peer, retrying until it is up
+        # The interval between attempts doubles up to max_retry_interval, and after timeout seconds the last error is raised
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
         while True:
-            data = conn.recv(1)
-            if not data: break
-            # First we're always going to get the NodeServerMsg data
-            typ = int.from_bytes(data, 'big')
-
-            if typ == NetworkMsg.INV.value:
-                # Receive INV
-                print('Receiving INV...')
-                data = conn.recv(32)
-                self.merkle_root = data
-                print("Received INV of size 32 bytes")
-                self.total_received += 32
-            elif typ == NetworkMsg.GET_GLBLK.value:
-                # Receive GET_GLBLK
-                print('Receiving GET_GLBLK...')
-                data = conn.recv(3)
-                self.other_txpool_size = int.from_bytes(data, 'big')
-                print("Received GET_GRBLK of size 3 bytes")
-                self.total_received += 3
-            elif typ == NetworkMsg.GLBLK.value:
-                # Receive TX Bloom
-                print('Receiving GLBLK...')
-                data = conn.recv(3)
-                tx_bloom_len = int.from_bytes(data, 'big')
-
-                data = conn.recv(tx_bloom_len)
-                tx_bloom = BloomFilter.deserialise(data)
-                print("Received TX Bloom of size %d bytes" % tx_bloom_len)
-
-                # Receive TX IBLT
-                data = conn.recv(3)
-                tx_iblt_len = int.from_bytes(data, 'big')
-
-                data = conn.recv(tx_iblt_len)
-                tx_iblt = SIBLT.deserialise(data)
-                print("Received TX IBLT of size %d bytes" % tx_iblt_len)
-                self.total_received += tx_bloom_len + tx_iblt_len
-
-                # Construct GLBLK
-                self.tx_filters = [tx_bloom, tx_iblt]
-            elif typ == NetworkMsg.GET_GLBLKDAT.value:
-                # Receive GET_GLBLKDAT
-                print('Receiving GET_GLBLKDAT...')
-                data = conn.recv(3)
-                pair_filter_len = int.from_bytes(data, 'big')
-
-                data = conn.recv(pair_filter_len)
-                self.tx_missing_ids = cpickle.loads(data)
-                print("Received GET_GLBLKDAT of size %d bytes" % pair_filter_len)
-                self.total_received += pair_filter_len
-            elif typ == NetworkMsg.GLBLKTX.value:
-                # Receive GLBLKTX
-                print('Receiving GLBLKTX...')
-                data = conn.recv(3)
-                tx_missing_length = int.from_bytes(data, 'big')
-
-                data = conn.recv(tx_missing_length)
-                self.tx_missing = cpickle.loads(data)
-                print("Received GLBLKTX of size %d bytes" % tx_missing_length)
-                self.total_received += tx_missing_length
-            elif typ == NetworkMsg.GLBLKORD.value:
-                # Receive TX
-                print('Receiving GLBLKORD...')
-                data = conn.recv(3)
-                bloom_len = int.from_bytes(data, 'big')
-
-                data = conn.recv(bloom_len)
-                pair_bloom = BloomFilter.deserialise(data)
-                print("Received Bloom of size %d bytes" % bloom_len)
-
-                # Receive IBLT
-                data = conn.recv(3)
-                iblt_len = int.from_bytes(data, 'big')
-
-                data = conn.recv(iblt_len)
-                pair_iblt = SIBLT.deserialise(data)
-                print("Received IBLT of size %d bytes" % iblt_len)
-                self.total_received += bloom_len + iblt_len
-                self.total_ord_received += bloom_len + iblt_len
-
-                # Construct GLBLK
-                self.pair_filters.append([pair_bloom, pair_iblt])
-            elif typ == NetworkMsg.COMPLETE.value:
-                # Receive reconciliation analytics
-                print('Receiving reconciliation analytics...')
-                data = conn.recv(1)
-                # TODO: Implement
-                self.complete = data
-                print('Received analytics of size %d bytes' % 1)
-                self.total_received += 1
-
-        conn.close()
+            try:
+                return self.add_session(await self.transport.connect(ip, port), (ip, port))
+            except OSError:
+                # Peer not up yet
+                if deadline is not None and loop.time() + retry_interval > deadline:
+                    raise
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(2 * retry_interval, max_retry_interval)
+
+    async def wait_for_peer(self):
+        # Wait for the next accepted peer and return its session
+        return await self.accepted.get()
+
+    async def wait_for_peers(self, n):
+        return [await self.wait_for_peer() for i in range(n)]
+
+    async def server_handler(self):
+        while True:
+            try:
+                conn, addr = await self.listener.accept()
+            except OSError:
+                return
+
+            print("Connection from %s" % (addr[0]))
+            self.accepted.put_nowait(self.add_session(conn, addr))
 
     def shutdown(self):
-        if(self.sock is not None):
-            self.sock.close()
+        if self.handler_task is not None:
+            self.handler_task.cancel()
+        for session in self.sessions:
+            session.close()
+        if(self.listener is not None):
+            self.listener.close()
             print("Server shutdown %s : %d" % (self.ip, self.port))
-        if(self.client_sock is not None):
-            self.client_sock.close()
\ No newline at end of file
@@ -1,20 +1,31 @@
+from block_context import BlockContext
+from fingerprint import Fingerprints
 from merkle_tree import PartialMerkleTree
 from networking import NodeServer
+from protoblock import ProtoBlock
+from sketch_cache import SketchCache
+from telemetry import Telemetry
+import asyncio
+import concurrent.futures
 import byte_tools as bt
 import filter_ops as fo
-import threading
+import param_planner
 
 class Node():
-    def __init__(self, mempool, block_tx_ids, ip, port):
-        # Initialise network parameters
+    def __init__(self, mempool, block_tx_ids, ip, port, transport=None):
+        # Initialise network parameters, transport defaults to TCP (see transport.py)
         self.ip = ip
         self.port = port
+        self.transport = transport
         self.server = None
+        self.sketch_cache = SketchCache()
+        self.telemetry = Telemetry()
 
         #Initialise transaction pool
         self.txpool = dict(zip([bt.sha256(tx.encode()) for tx in mempool], mempool))
         self.txpool[bt.empty_hash] = ""
         self.proto_block = None
+        self.block_context = None
 
         #Initialise leafs
         self.partial_tree = PartialMerkleTree.from_leaf_values(block_tx_ids)
@@ -26,105 +37,240 @@ class Node():
         self.id_encoding_size = 8
         self.pair_encoding_size = 3 # TODO: This should dynamically change as we progress in height
 
+        # Bloom and IBLT hashes of txpool transactions, taken on arrival so relays only look them up
+        self.fingerprints = Fingerprints(key_size=self.id_encoding_size)
+        self.fingerprints.add(list(self.txpool))
 
-    def init_server(self):
-        self.server = NodeServer(self.ip, self.port)
-        self.server.start()
+        # Opt in parallel txpool filtering in prereconcile, the number of worker processes (0 to filter in process)
+        self.prereconcile_workers = 0
+        self.prereconcile_pool = None
 
-    def open_connection(self, ip, port):
-        self.server.connectTo(ip, port)
+        # IBLT differences being decoded, kept so they can be extended, and the number of extensions to ask for
+        # before giving up on the relay, each one doubles the cells received so far
+        self.tx_difference = None
+        self.pair_difference = None
+        self.max_extensions = 8
+
+        # Reconcile each order level in a worker thread, so the session keeps receiving and decoding the next levels
+        self.pipeline_order = True
+
+
+    async def init_server(self):
+        self.server = NodeServer(self.ip, self.port, transport=self.transport)
+        await self.server.start()
+
+    async def open_connection(self, ip, port):
+        # Returns the session to the peer
+        return await self.server.connect_to(ip, port)
 
     def close_connection(self):
         self.server.shutdown()
+        if self.prereconcile_pool is not None:
+            self.prereconcile_pool.shutdown()
+            self.prereconcile_pool = None
 
     def get_block_tx_ids(self):
         return self.partial_tree.get_leafs()
 
     def get_merkle_root(self):
-        top_nodes = self.partial_tree.top_nodes
-
-        temp_tree = PartialMerkleTree(top_nodes)
+        return self.partial_tree.get_root()
 
-        temp_tree.make_tree()
-        return temp_tree.get_top_values()[0]
+    def get_block_context(self):
+        # Sender side context of the block, rebuilt only when the block or the ID encoding changes
+        if self.block_context is None or not self.block_context.is_current(self.partial_tree, self.id_encoding_scheme):
+            self.block_context = BlockContext(self.partial_tree, self.txpool, self.id_encoding_scheme, self.fingerprints)
+        return self.block_context
 
     def get_block(self):
         # Get block by using leafs as keys to txpool
         return [self.txpool[ref] for ref in self.partial_tree.get_leafs()]
 
     def add_to_txpool(self, txs):
-        # Add transactions to txpool
+        # Add transactions to txpool, new ones are fingerprinted in the order the txpool gets them
         # TODO: This can be more efficiently done (insert instead of append)
+        self.fingerprints.add([tx_id for tx_id in txs if tx_id not in self.txpool])
         self.txpool = {**self.txpool, **txs}
 
     def remove_from_block(self, tx_ids):
-        # Remove transactions from block
-        block_tx_refs = self.get_block_tx_ids()
-        for tx_id in tx_ids:
-            block_tx_refs.remove(tx_id)
-
-        self.partial_tree = PartialMerkleTree.from_leaf_values(block_tx_refs) # TODO: Very wasteful, fix this
+        # Remove transactions from block, in place, so only the Merkle paths above the moved leafs are rehashed
+        self.partial_tree.remove_leafs(tx_ids)
+        self.block_context = None
 
     def create_block_bloom(self, error_rate=0.1):
         # Create bloom filter from memory/orphan pool
-        block_tx_ids = self.get_block_tx_ids()
-        block_length = len(block_tx_ids)
-        return fo.create_bloom(block_tx_ids, block_length, error_rate=error_rate)
+        block_context = self.get_block_context()
+        block_length = len(block_context)
+        return fo.create_bloom(block_context.tx_ids, block_length, error_rate, self.fingerprints, block_context.fingerprint_rows)
 
-    def create_block_iblt(self, n_cells=300):
+    def create_block_iblt(self, n_cells=300, n_hashes=4):
         # Create IBLT from block
-        enc_block_tx_ids = [self.id_encoding_scheme.encode(tx) for tx in self.get_block_tx_ids()]
+        block_context = self.get_block_context()
         key_size = self.id_encoding_scheme.length
-        return fo.create_iblt(enc_block_tx_ids, key_size=key_size, n_cells=n_cells)
+        return fo.create_iblt(block_context.encoded_ids, key_size=key_size, n_cells=n_cells, n_hashes=n_hashes, partitioned=True,
+                              fingerprints=self.fingerprints, rows=block_context.fingerprint_rows)
 
     def setup_id_encoding(self, priors):
-        self.id_encoding_scheme = bt.IdEncodingScheme.BasicTruncatedEncoding(priors, n_bytes=self.id_encoding_size)
+        self.id_encoding_scheme = bt.IdEncodingScheme.IndexedTruncatedEncoding(priors, n_bytes=self.id_encoding_size)
+        if self.id_encoding_scheme.collisions:
+            print('Warning: %d short ID collisions at %d bytes' % (len(self.id_encoding_scheme.collisions), self.id_encoding_size))
 
-    def setup_pair_encoding(self, priors, basic=True):
+    def setup_pair_encoding(self, priors, basic=False):
+        self.pair_encoding_scheme = self.make_pair_encoding(priors, basic)
+
+    def make_pair_encoding(self, priors, basic=False):
         # Set up pair encoding
         if basic:
             # At 2 bytes and 2000 tx's this collides 99.99...% of the time
             # At 3 bytes and 2000 tx's this collides ~12% of the time
             # At 4 bytes and 2000 tx's this collides ~0.04% of the time
-            node_id_enc = bt.IdEncodingScheme.BasicTruncatedEncoding(priors, n_bytes=self.pair_encoding_size)
-            self.pair_encoding_scheme = bt.PairEncodingScheme.DoubleIdEncoding(node_id_enc)
+            node_id_enc = bt.IdEncodingScheme.IndexedTruncatedEncoding(priors, n_bytes=self.pair_encoding_size)
+            return bt.PairEncodingScheme.DoubleIdEncoding(node_id_enc)
         else:
-            top_values = self.partial_tree.get_top_values()
-            self.pair_encoding_scheme = bt.PairEncodingScheme.IntSortEncoding(top_values)
+            # Ranks among the top values, both peers hold the same top values once lower heights are reconciled
+            return bt.PairEncodingScheme.RankEncoding(priors)
 
 
-    def create_pairs_iblt(self, n_cells=300):
+    def create_pairs_iblt(self, n_cells=300, tree=None, pair_encoding_scheme=None, n_hashes=4):
         # Create IBLT from pairs at top on partial tree
-        encoded_pairs = [self.pair_encoding_scheme.encode(*pair) for pair in self.partial_tree.get_top_value_pairs()]
-        key_size = self.pair_encoding_scheme.length
-        return fo.create_iblt(encoded_pairs, n_cells=n_cells, key_size=key_size)
-
-    def create_pairs_bloom(self, error_rate=0.1):
+        if tree is None:
+            tree = self.partial_tree
+        if pair_encoding_scheme is None:
+            pair_encoding_scheme = self.pair_encoding_scheme
+        encoded_pairs = pair_encoding_scheme.encode_many(tree.get_top_value_pairs())
+        key_size = pair_encoding_scheme.length
+        return fo.create_iblt(encoded_pairs, n_cells=n_cells, key_size=key_size, n_hashes=n_hashes, partitioned=True)
+
+    def create_pairs_bloom(self, error_rate=0.1, tree=None):
         # Create Bloom filter for pairs
+        if tree is None:
+            tree = self.partial_tree
 
         # Encode pairs (no compression needed)
-        encoded_pairs = [a+b for a,b in self.partial_tree.get_top_value_pairs()]
+        encoded_pairs = [a+b for a,b in tree.get_top_value_pairs()]
         n_enc_pairs = len(encoded_pairs)
 
         # Create bloom
         return fo.create_bloom(encoded_pairs, capacity=n_enc_pairs, error_rate=error_rate)
 
+    def block_sketch(self, m, est_missing_tx_perc):
+        # Bloom filter and IBLT of the block for a receiver with m transactions in its pool
+        n = len(self.get_block_context())
+        fpr, n_cells, n_hashes = param_planner.plan_block(n, m, est_missing_tx_perc, self.id_encoding_scheme.length)
+
+        with self.telemetry.phase('bloom_build', sketch='tx', items=n, fpr=fpr):
+            block_bloom = self.create_block_bloom(error_rate=fpr)
+        with self.telemetry.phase('iblt_build', sketch='tx', cells=n_cells, hashes=n_hashes):
+            block_iblt = self.create_block_iblt(n_cells, n_hashes)
+        return block_bloom, block_iblt
+
+    def order_levels(self):
+        # Yield a function returning the tree at each height of the block's Merkle tree, from the leafs up
+        # Trees are climbed on a copy of the leafs so relays to several peers don't interfere,
+        # and only once a level is asked for so relays served by the sketch cache skip the hashing
+        block_tx_ids = self.get_block_context().tx_ids
+        state = {'tree': None, 'height': 0}
+
+        def tree_at(height):
+            if state['tree'] is None or state['height'] > height:
+                # Extensions may ask for a height already climbed past
+                state['tree'] = PartialMerkleTree.from_leaf_values(block_tx_ids)
+                state['height'] = 0
+            while state['height'] < height:
+                # Increment Merkle tree height
+                state['tree'].add_merkle_level()
+                state['height'] += 1
+            return state['tree']
+
+        n_top = len(block_tx_ids) + len(block_tx_ids) % 2
+        height = 0
+        while n_top > 1:
+            yield lambda h=height: tree_at(h)
+            n_top = (n_top + 1) // 2
+            height += 1
+
+    def order_sketch(self, tree, est_missing_pair_perc):
+        # Pair Bloom filter and IBLT at the current height of the tree, and the digest of the pair encoding
+        # Setup pair encoding
+        pair_encoding_scheme = self.make_pair_encoding(tree.get_top_values())
+
+        # Calculate Gluon block order data
+        n = len(tree.top_nodes)
+        fpr, n_cells, n_hashes = param_planner.plan_order(n, est_missing_pair_perc, pair_encoding_scheme.length)
+
+        with self.telemetry.phase('bloom_build', sketch='order', items=n // 2, fpr=fpr):
+            pair_bloom = self.create_pairs_bloom(fpr, tree)
+        with self.telemetry.phase('iblt_build', sketch='order', cells=n_cells, hashes=n_hashes):
+            pair_iblt = self.create_pairs_iblt(n_cells, tree, pair_encoding_scheme, n_hashes)
+        return pair_bloom, pair_iblt, pair_encoding_scheme.digest
+
+    def extension_sketch(self, request, levels):
+        # IBLT over the keys of a sketch already sent, under the seed and size the receiver asked for
+        from networking import EXT_TX_PHASE
+        if request.phase == EXT_TX_PHASE:
+            keys = self.get_block_context().encoded_ids
+            key_size = self.id_encoding_scheme.length
+        else:
+            tree = levels[request.height]()
+            pair_encoding_scheme = self.make_pair_encoding(tree.get_top_values())
+            keys = pair_encoding_scheme.encode_many(tree.get_top_value_pairs())
+            key_size = pair_encoding_scheme.length
+        return fo.create_iblt(keys, request.n_cells, request.n_hashes, key_size, seed=request.seed, partitioned=True)
+
     def prereconcile(self, bloom, iblt_other):
         # Begin to reconcile block by creating a protoblock
 
-        # Filter protoblock using bloom
-        self.proto_block = [tx_id for tx_id in self.txpool.keys() if tx_id in bloom]
-        self.setup_id_encoding(self.proto_block)
-        encoded_proto_block = [self.id_encoding_scheme.encode(tx_id) for tx_id in self.proto_block]
-
-        # Create IBLT from bloom filtered mempool
-        n_cells = len(iblt_other.T)
-        key_size = self.id_encoding_scheme.length
-        iblt = fo.create_iblt(encoded_proto_block, key_size=key_size, n_cells=n_cells)
+        tx_ids = list(self.txpool.keys())
+        n_cells = iblt_other.n_cells
+        if self.prereconcile_workers:
+            # Filter shards of the mempool and build their IBLTs in worker processes
+            # Workers truncate IDs themselves, as the ID encoding does
+            if self.prereconcile_pool is None:
+                self.prereconcile_pool = concurrent.futures.ProcessPoolExecutor(self.prereconcile_workers)
+            with self.telemetry.phase('bloom_filter', sketch='tx', items=len(tx_ids), workers=self.prereconcile_workers):
+                proto_block, iblt = fo.sharded_filter(self.prereconcile_pool, self.prereconcile_workers, bloom, tx_ids,
+                                                      self.id_encoding_size, n_cells, iblt_other.n_hash_functions,
+                                                      iblt_other.key_sum_size, iblt_other.partitioned)
+                self.setup_id_encoding(proto_block)
+            # Encoded IDs are only needed to extend the difference
+            encoded_proto_block = lambda: [self.id_encoding_scheme.encode(tx_id) for tx_id in proto_block]
+        else:
+            # Filter protoblock using bloom
+            # Hashes come from the txpool's fingerprints, whose rows are in txpool order
+            with self.telemetry.phase('bloom_filter', sketch='tx', items=len(tx_ids)):
+                rows = self.fingerprints.pool_rows(tx_ids)
+                passed = bloom.contains_many(tx_ids, self.fingerprints.bloom_digests(rows))
+                proto_block = [tx_id for tx_id, p in zip(tx_ids, passed) if p]
+                rows = rows[passed]
+                self.setup_id_encoding(proto_block)
+                encoded_proto_block = [self.id_encoding_scheme.encode(tx_id) for tx_id in proto_block]
+
+            # Create IBLT from bloom filtered mempool
+            with self.telemetry.phase('iblt_build', sketch='tx', cells=n_cells, hashes=iblt_other.n_hash_functions):
+                iblt = fo.create_iblt_like(encoded_proto_block, iblt_other, self.id_encoding_scheme.length, self.fingerprints, rows)
+        self.proto_block = ProtoBlock(proto_block)
+
+        # Calculate missing transactions, the difference is kept in case it has to be extended
+        print('Calculating IBLT Subtraction...')
+        with self.telemetry.phase('subtract', sketch='tx'):
+            self.tx_difference = fo.IBLTDifference(iblt_other, iblt, encoded_proto_block, self.id_encoding_scheme.length)
+        return self.resolve_tx_difference(self.decode_difference(self.tx_difference, 'tx'))
+
+    def decode_difference(self, difference, sketch, height=0, ext_iblt=None):
+        # Decode an IBLT difference, first extended by ext_iblt if given, and record the outcome
+        with self.telemetry.phase('peel', sketch=sketch, height=height) as fields:
+            if ext_iblt is None:
+                diff_results = difference.decode()
+            else:
+                diff_results = difference.extend(ext_iblt)
+            fields.update(outcome=diff_results[0], cells=difference.n_cells, **difference.stats)
+        return diff_results
 
-        # Calculate missing transactions
-        enc_missing_tx_ids, enc_excess_tx_ids = fo.get_iblt_missing_excess(iblt_other,iblt)
-        excess_tx_ids = [self.id_encoding_scheme.decode(enc_excess_tx_id) for enc_excess_tx_id in enc_excess_tx_ids]
+    def resolve_tx_difference(self, diff_results):
+        # Remove excess transactions from the protoblock and return the missing ones, None if the difference didn't decode
+        status, enc_missing_tx_ids, enc_excess_tx_ids = diff_results
+        if status != 'Success':
+            return None
+        excess_tx_ids = self.id_encoding_scheme.decode_many(enc_excess_tx_ids)
 
         # Remove excess transactions from mempool using IBLT
         if len(excess_tx_ids) > 0:
@@ -153,7 +299,7 @@ class Node():
                 tx_id = bt.sha256(tx.encode())
                 missing_tx_ids.append(tx_id)
                 if next_id in self.proto_block:
-                    self.proto_block.insert(self.proto_block.index(next_id), tx_id)
+                    self.proto_block.insert_before(tx_id, next_id)
                 elif next_id == b'\x00':
                     self.proto_block.append(tx_id)
 
@@ -166,69 +312,52 @@ class Node():
     def missing_response(self, enc_missing_tx_ids):
         # Calculate response to missing tx request
         # TODO: Catch no responses
-        missing_tx_ids = [self.id_encoding_scheme.decode(tx_id) for tx_id in enc_missing_tx_ids]
-        if missing_tx_ids == []:
-            return []
-        block_tx_ids = self.get_block_tx_ids()
-
-        # Sort missing tx IDs by the order in which they appear in own block
-        def get_block_index(v):
-            return block_tx_ids.index(v)
+        missing_tx_ids = self.id_encoding_scheme.decode_many(enc_missing_tx_ids)
 
-        missing_tx_ids.sort(key=get_block_index)
-
-        # Get missing txs from mempool
-        missing_tx = [self.txpool[tx_id] for tx_id in missing_tx_ids]
-
-        # Get ID after (in own block) each missing tx
-        missing_tx_ids_next = [block_tx_ids[block_tx_ids.index(tx_id) + 1] for tx_id in missing_tx_ids[:-1]] # TODO: Shorten
-        last_missing_id = missing_tx_ids[-1]
-
-        if block_tx_ids[-1] == last_missing_id:
-            # If last missing ID is the last ID in the block then flag it
-            missing_tx_ids_next.append(b'\x00')
-        else:
-            missing_tx_ids_next.append(block_tx_ids[block_tx_ids.index(last_missing_id) + 1])
-        missing_tx_ids_next.append(None) #TODO: Needed?
         # Consecutive transactions are grouped into segments
         # Segments are labelled with the first transactions previous tx id
-        segments = []
-        segment = []
-        for i in range(len(missing_tx) - 1):
-            if missing_tx_ids[i + 1] == missing_tx_ids_next[i]:
-                segment.append(missing_tx[i])
-            else:
-                segment.append(missing_tx[i])
-                segments.append((self.id_encoding_scheme.encode(missing_tx_ids_next[i]), segment))
-                segment = []
-        i = len(missing_tx) - 1
-        segment.append(missing_tx[i])
-        if missing_tx_ids_next[i] != b'\x00':
-            # If the last missing ID is not last in the block don't encode the flag
-            segments.append((missing_tx_ids_next[i], segment))
-        else:
-            segments.append((self.id_encoding_scheme.encode(missing_tx_ids_next[i]), segment))
+        return self.get_block_context().missing_segments(missing_tx_ids)
 
-        return segments
+    def reconcile_pairs(self, bloom, other_iblt, height=0, digest=None):
+        # digest: the sender's pair encoding digest, pairs would decode to the wrong values if it differs from ours
+        # Returns None if the pairs didn't decode, pair_difference is then None too if extending it can't help
+        if digest is not None and digest != self.pair_encoding_scheme.digest:
+            print('Pair encoding mismatch at height %d, top values differ from the sender\'s' % height)
+            self.pair_difference = None
+            return None
 
-    def reconcile_pairs(self, bloom, other_iblt):
         # Encode top pairs which pass bloom filter
-        encoded_top_pairs_bloomed = [self.pair_encoding_scheme.encode(*pair) for pair in self.partial_tree.get_top_value_pairs() if pair[0]+pair[1] in bloom]
+        top_pairs = self.partial_tree.get_top_value_pairs()
+        passed = bloom.contains_many([pair[0]+pair[1] for pair in top_pairs])
+        encoded_top_pairs_bloomed = self.pair_encoding_scheme.encode_many([pair for pair, p in zip(top_pairs, passed) if p])
 
         # Create IBLT from these pairs
-        cell_count = len(other_iblt.T)
         key_size = self.pair_encoding_scheme.length
-        iblt = fo.create_iblt(encoded_top_pairs_bloomed, n_cells=cell_count, key_size=key_size)
+        iblt = fo.create_iblt_like(encoded_top_pairs_bloomed, other_iblt, key_size)
 
         ## No bloom here?
         #encoded_top_pairs = [self.pair_encoding_scheme.encode(*pair) for pair in self.partial_tree.get_top_value_pairs()]
         #iblt = fo.create_iblt(encoded_top_pairs, n_cells=cell_count, key_size=key_size)
 
-        # Get missing pairs via subtraction and IBLT decoding
-        encoded_missing_pairs, _ = fo.get_iblt_missing_excess(other_iblt, iblt)
+        # Get missing pairs via subtraction and IBLT decoding, the difference is kept in case it has to be extended
+        print('Calculating IBLT Subtraction...')
+        with self.telemetry.phase('subtract', sketch='order', height=height):
+            self.pair_difference = fo.IBLTDifference(other_iblt, iblt, encoded_top_pairs_bloomed, key_size)
+        return self.resolve_pair_difference(self.decode_difference(self.pair_difference, 'order', height))
+
+    def reconcile_level(self, height, bloom, other_iblt, digest=None):
+        # Reconcile pairs at one order level, timed in the thread it runs in
+        with self.telemetry.phase('order_level', height=height, top_nodes=len(self.partial_tree.top_nodes)):
+            return self.reconcile_pairs(bloom, other_iblt, height, digest)
+
+    def resolve_pair_difference(self, diff_results):
+        # Reconcile order with the missing pairs, returns None if the difference didn't decode
+        status, encoded_missing_pairs, _ = diff_results
+        if status != 'Success':
+            return None
 
         # Decode missing pairs
-        missing_pairs = [self.pair_encoding_scheme.decode(encoded_pair) for encoded_pair in encoded_missing_pairs]
+        missing_pairs = self.pair_encoding_scheme.decode_many(encoded_missing_pairs)
 
         # Perform reconciliation
         if missing_pairs != []:
@@ -238,154 +367,252 @@ class Node():
             # If no missing pairs return True
             return True
 
-    def send_block(self, est_missing_tx_perc, est_missing_pair_perc):
-        from networking import NetworkMsg
-        block = self.get_block()
+    async def extend_difference(self, session, phase, height, difference):
+        # Ask the sender for IBLT extensions until the difference decodes, the Bloom filter is not resent
+        # Returns None if it still doesn't decode after max_extensions
+        from networking import NetworkMsg, ExtRequest, EXT_TX_PHASE
+        sketch = 'tx' if phase == EXT_TX_PHASE else 'order'
+        for i in range(self.max_extensions):
+            request = ExtRequest(phase, height, difference.next_seed, difference.n_cells, difference.n_hashes)
+            await session.send(NetworkMsg.GET_GLBLKEXT, request)
+            ext_iblt = await session.wait_for(NetworkMsg.GLBLKEXT)
+            diff_results = self.decode_difference(difference, sketch, height, ext_iblt)
+            if diff_results[0] == 'Success':
+                return diff_results
+        print('%s IBLT decoding failure after %d extensions' % (sketch, self.max_extensions))
+        return None
+
+    def abort_relay(self, session, sketch):
+        # End a relay whose IBLTs couldn't be decoded, the sender sees the session close without COMPLETE
+        self.telemetry.record('relay', peer=session.addr[0], bytes=session.stats(), failed=sketch)
+        print('Transfer incomplete')
+        session.close()
+        return False
+
+    async def send_block(self, est_missing_tx_perc, est_missing_pair_perc, peers=None, order_window=4):
+        # Relay the block to each peer concurrently, by default to every connected peer
+        if peers is None:
+            peers = list(self.server.sessions)
         self.setup_id_encoding(self.get_block_tx_ids())
 
+        # Build the block context once, it is shared by every relay
+        self.get_block_context()
+
         # Create INV (~ Merkle Root)
         merkle_root = self.get_merkle_root()
 
+        # A peer that disconnects fails its own relay only
+        results = await asyncio.gather(*[self.relay_block(session, merkle_root, est_missing_tx_perc, est_missing_pair_perc,
+                                                          order_window)
+                                         for session in peers], return_exceptions=True)
+        for session, result in zip(peers, results):
+            if isinstance(result, ConnectionError):
+                print('Transfer to %s incomplete: %s' % (session.addr[0], result))
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, ConnectionError):
+                raise result
+
+    async def relay_block(self, session, merkle_root, est_missing_tx_perc, est_missing_pair_perc, order_window=4):
+        # order_window: order levels sent ahead of the last one the receiver acknowledged, None to send every level
+        # Raises ConnectionError if the session ends before the receiver reports completion
+        from networking import NetworkMsg, encode_message
+        block_context = self.get_block_context()
+
         # Send Inv
-        self.server.send(NetworkMsg.INV, merkle_root)
+        await session.send(NetworkMsg.INV, merkle_root)
 
         # Wait for Get Gluon block message
-        self.server.waitOn(NetworkMsg.GET_GLBLK)
-
-        # Calculate Gluon block
-        n = len(block)
-        print('Sending block consisting of %d transactions...' % n)
-        m = self.server.other_txpool_size
-        cell_overhead = 1.5
-        cell_size = 8*(3 + self.id_encoding_scheme.length + 4) * cell_overhead
-        est_excess_tx_perc = (m - n * (1 - est_missing_tx_perc)) / m
-
-        multiplier = 1
+        m = await session.wait_for(NetworkMsg.GET_GLBLK)
 
-        fpr, n_cells = fo.optimum_params(n, m, est_missing_tx_perc, est_excess_tx_perc, cell_size)
-        n_cells = max([n_cells, 5])  # TODO: Bound n_cell fall off in a less hacky way
-
-        block_bloom = self.create_block_bloom(error_rate=fpr)
-        block_iblt = self.create_block_iblt(int(multiplier*n_cells))
+        # Calculate Gluon block, shared by all peers in the same mempool size bucket
+        print('Sending block consisting of %d transactions...' % len(block_context))
+        bucket, m = self.sketch_cache.bucket(m)
+        glblk = self.sketch_cache.get((NetworkMsg.GLBLK, merkle_root, bucket, est_missing_tx_perc),
+                                      lambda: encode_message(NetworkMsg.GLBLK, self.block_sketch(m, est_missing_tx_perc)))
 
         # Send Gluon block
-        self.server.send(NetworkMsg.GLBLK, [block_bloom, block_iblt])
-
-        def send_order():
-            # Send order information
-            while len(self.partial_tree.top_nodes) > 1:
-                # Python is the bottleneck here, slowing down transfer speed makes it more realistic
-                # Also makes it easy on the network threading
-                import time
-                time.sleep(2)
-
-                # Check whether reconciliation is complete
-                if self.server.complete is not None:
-                    self.close_connection()
-                    print('Transfer complete')
-                    print('Analytics:')
-                    print('Total of %d bytes received' % self.server.total_received)
-                    print('Total of %d bytes sent' % self.server.total_sent)
-                    print('Total of %d order bytes sent' % self.server.total_ord_sent)
-                    # TODO: Nodes communicate analytics for future parameter improvements
+        await session.send_encoded(NetworkMsg.GLBLK, glblk)
+
+        levels = list(self.order_levels())
+
+        # The relay ends once the receiver reports completion or the session closes
+        complete = asyncio.ensure_future(session.wait_for(NetworkMsg.COMPLETE))
+
+        async def serve_extensions():
+            # Answer requests for IBLT extensions until the relay ends, including after the last order level is sent
+            while True:
+                request = await session.wait_for(NetworkMsg.GET_GLBLKEXT)
+                print('Extending %s IBLT with %d cells' % ('order' if request.phase else 'tx', request.n_cells))
+                glblkext = self.sketch_cache.get((NetworkMsg.GLBLKEXT, merkle_root) + tuple(request),
+                                                 lambda: encode_message(NetworkMsg.GLBLKEXT, self.extension_sketch(request, levels)))
+                await session.send_encoded(NetworkMsg.GLBLKEXT, glblkext)
+
+        async def send_order():
+            # Stream order levels as soon as they are built, stopping once the receiver reports completion
+            # The receiver acknowledges each level it has reconciled, at most order_window levels are unacknowledged
+            n_acked = 0
+            for height, tree_at in enumerate(levels):
+                while order_window is not None and height >= n_acked + order_window and not complete.done():
+                    ack = asyncio.ensure_future(session.wait_for(NetworkMsg.GLBLKORDACK))
+                    try:
+                        await asyncio.wait([ack, complete], return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        if not ack.done():
+                            ack.cancel()
+                        elif not ack.cancelled():
+                            # Retrieved here too, the ack may fail as the session closes while this task is cancelled
+                            ack.exception()
+                    if not ack.done() or ack.cancelled():
+                        continue
+                    if ack.exception() is not None:
+                        # The session ended, the relay's outcome is that of waiting for COMPLETE
+                        return
+                    n_acked = ack.result() + 1
+                if complete.done():
                     break
 
-                # Setup pair encoding
-                self.setup_pair_encoding(self.partial_tree.get_top_values())
-
-                # Calculate Gluon block order data
-                n = len(self.partial_tree.top_nodes)  # Not quite 2
-                cell_size = 8 * (3 + self.pair_encoding_scheme.length + 4) * cell_overhead
-
-                multiplier = 1
-
-                fpr, n_cells = fo.optimum_params(n, m, est_missing_pair_perc, est_missing_pair_perc, cell_size)
-                n_cells = max([n_cells, 5]) # TODO: Bound n_cell fall off in a less hacky way
-                # n_cells = max(18, n_cells)
-                pair_bloom = self.create_pairs_bloom(fpr)
-                pair_iblt = self.create_pairs_iblt(int(multiplier * n_cells))
-
-                # Send Gluon block order data
-                self.server.send(NetworkMsg.GLBLKORD, [pair_bloom, pair_iblt])
+                # Calculate and send Gluon block order data
+                glblkord = self.sketch_cache.get((NetworkMsg.GLBLKORD, merkle_root, est_missing_pair_perc, height),
+                                                 lambda: encode_message(NetworkMsg.GLBLKORD, self.order_sketch(tree_at(), est_missing_pair_perc)))
+                try:
+                    await session.send_encoded(NetworkMsg.GLBLKORD, glblkord)
+                except ConnectionError:
+                    # The receiver may complete and close the session while a level is being sent
+                    return
+
+                # Let the session read a COMPLETE that has arrived before building the next level
+                await asyncio.sleep(0)
+
+        # Send Gluon block order data and extensions
+        order_task = asyncio.ensure_future(send_order())
+        extension_task = asyncio.ensure_future(serve_extensions())
+        try:
+            # Wait for Get Gluon block data message
+            tx_missing_ids = await session.wait_for(NetworkMsg.GET_GLBLKDAT)
+
+            # Calculate Gluon block tx data
+            missing_tx_response = self.missing_response(tx_missing_ids)
+
+            # Send Gluon block tx data
+            await session.send(NetworkMsg.GLBLKTX, missing_tx_response)
+
+            # Extensions are served until the relay ends, the receiver may ask for one after the last level
+            await order_task
+            peer_stats = await complete
+        finally:
+            for task in (order_task, extension_task, complete):
+                task.cancel()
+            await asyncio.gather(order_task, extension_task, complete, return_exceptions=True)
+            session.close()
+
+        print('Transfer complete')
+        print('Analytics:')
+        print('Total of %d bytes received' % session.total_received)
+        print('Total of %d bytes sent' % session.total_sent)
+        print('Total of %d order bytes sent' % session.total_ord_sent)
+        print('Total of %d recovery bytes sent' % session.total_ext_sent)
+        print('Sketch cache', self.sketch_cache.stats())
+        print('Peer decodes', peer_stats['decodes'])
+
+        # The receiver's decode outcomes are kept to tune est_missing_tx_perc and est_missing_pair_perc
+        self.telemetry.record('relay', peer=session.addr[0], bytes=session.stats(), peer_stats=peer_stats)
+
+    async def listen_for_blocks(self, session=None):
+        from networking import NetworkMsg, EXT_TX_PHASE, EXT_ORDER_PHASE
+        # Listen to the given peer, by default the next one to connect, returns whether the block was reconciled
+        if session is None:
+            session = await self.server.wait_for_peer()
 
-                # Increment Merkle tree height
-                self.partial_tree.add_merkle_level()
-
-        # Send Gluon block order data
-        threading.Thread(target=send_order).start()
-
-        # Wait for Get Gluon block data message
-        self.server.waitOn(NetworkMsg.GET_GLBLKDAT)
-
-        # Calculate Gluon block tx data
-        missing_tx_response = self.missing_response(self.server.tx_missing_ids)
-
-        # Send Gluon block tx data
-        self.server.send(NetworkMsg.GLBLKTX, missing_tx_response)
-
-    def listen_for_blocks(self):
-        from networking import NetworkMsg
         # Wait for INV
-        self.server.waitOn(NetworkMsg.INV)
+        incoming_merkle_root = await session.wait_for(NetworkMsg.INV)
+        start = self.telemetry.record('inv', peer=session.addr[0])['time']
 
         # Pretend lacking block
         # TODO: Actually check
-        incoming_merkle_root = self.server.merkle_root
 
         # Send the Get Gluon Block message (size of mempool)
         m = len(self.txpool)
 
-        self.server.send(NetworkMsg.GET_GLBLK, m)
+        await session.send(NetworkMsg.GET_GLBLK, m)
 
         # Wait for Gluon Block
-        self.server.waitOn(NetworkMsg.GLBLK)
+        tx_bloom, tx_iblt = await session.wait_for(NetworkMsg.GLBLK)
 
         # Calculate missing transactions
         print('Construct GET_GLBLKDAT')
-        enc_missing_ids = self.prereconcile(self.server.tx_filters[0], self.server.tx_filters[1])
+        enc_missing_ids = self.prereconcile(tx_bloom, tx_iblt)
+        if enc_missing_ids is None:
+            diff_results = await self.extend_difference(session, EXT_TX_PHASE, 0, self.tx_difference)
+            if diff_results is None:
+                return self.abort_relay(session, 'tx')
+            enc_missing_ids = self.resolve_tx_difference(diff_results)
         print('Constructed')
 
         # Send GET_GLBLKDAT
-        self.server.send(NetworkMsg.GET_GLBLKDAT, enc_missing_ids)
+        await session.send(NetworkMsg.GET_GLBLKDAT, enc_missing_ids)
 
         # Wait for GLBLKTX
-        self.server.waitOn(NetworkMsg.GLBLKTX)
+        tx_missing = await session.wait_for(NetworkMsg.GLBLKTX)
 
         # Finish reconciling transactions
         print('Reconciling transactions...')
-        self.finalize_protoblock(self.server.tx_missing)
+        with self.telemetry.phase('protoblock_finalise', missing=sum(len(segment[1]) for segment in tx_missing)):
+            self.finalize_protoblock(tx_missing)
         print('Reconciled')
 
         # Reconcile order
+        height = 0
         while len(self.partial_tree.top_nodes) > 1:
             # Setup pair encoding
             self.setup_pair_encoding(self.partial_tree.get_top_values())
 
             # Wait for GLBLKORD
-            self.server.waitOn(NetworkMsg.GLBLKORD)
-            print('Cached pairs', len(self.server.pair_filters))
-            oldest_pair_filter = self.server.pair_filters.pop(0)
+            oldest_pair_filter = await session.wait_for(NetworkMsg.GLBLKORD)
+            print('Cached pairs', session.pending(NetworkMsg.GLBLKORD) + 1)
 
             print('Reconciling order...')
-            empty_missing_flag = self.reconcile_pairs(oldest_pair_filter[0], oldest_pair_filter[1])
+            if self.pipeline_order:
+                empty_missing_flag = await asyncio.get_event_loop().run_in_executor(
+                    None, self.reconcile_level, height, *oldest_pair_filter)
+            else:
+                empty_missing_flag = self.reconcile_level(height, *oldest_pair_filter)
+            if empty_missing_flag is None and self.pair_difference is None:
+                return self.abort_relay(session, 'order')
+            if empty_missing_flag is None:
+                diff_results = await self.extend_difference(session, EXT_ORDER_PHASE, height, self.pair_difference)
+                if diff_results is None:
+                    return self.abort_relay(session, 'order')
+                empty_missing_flag = self.resolve_pair_difference(diff_results)
             print('Reconciled')
 
             # Increment Merkle tree height
-            self.partial_tree.add_merkle_level()
+            with self.telemetry.phase('merkle_level', height=height):
+                self.partial_tree.add_merkle_level()
+            height += 1
 
             if empty_missing_flag:
                 print('Checking Merkle root...')
-                current_merkle_root = self.get_merkle_root()
+                with self.telemetry.phase('root_check', height=height):
+                    current_merkle_root = self.get_merkle_root()
                 if current_merkle_root == incoming_merkle_root:
                     print('Complete reconciliation')
-                    self.server.send(NetworkMsg.COMPLETE, None)
+
+                    # Our stats travel to the sender in COMPLETE
+                    stats = self.telemetry.snapshot(start)
+                    stats['bytes'] = session.stats()
+                    await session.send(NetworkMsg.COMPLETE, stats)
+                    self.telemetry.record('relay', peer=session.addr[0], bytes=session.stats())
                     print('Analytics:')
-                    print('Total of %d bytes received' % self.server.total_received)
-                    print('Total of %d order bytes received' % self.server.total_ord_received)
-                    print('Total of %d bytes sent' % self.server.total_sent)
+                    print('Total of %d bytes received' % session.total_received)
+                    print('Total of %d order bytes received' % session.total_ord_received)
+                    print('Total of %d recovery bytes received' % session.total_ext_received)
+                    print('Total of %d bytes sent' % session.total_sent)
                     break
                 else:
                     print('Incomplete reconciliation, continuing...')
 
-        self.close_connection()
-        exit()
\ No newline at end of file
+            # Let the sender send another level
+            await session.send(NetworkMsg.GLBLKORDACK, height - 1)
+
+        session.close()
+        return self.get_merkle_root() == incoming_merkle_root
@@ -0,0 +1,138 @@
+import numpy as np
+
+# Parameter planner for the Bloom filter and IBLT sent in each phase
+# The receiver filters its set through the sender's Bloom filter, the items wrongly passing the filter plus the
+# items it is missing must then be recovered from the IBLT. Every candidate count of wrongly passing items fixes
+# a false positive rate and so a Bloom filter size, and, through the table below, an IBLT size. All candidates
+# and hash counts are costed in one vectorised pass and the smallest total is returned.
+
+# Decode success target of an IBLT, as in Graphene
+DECODE_TARGET = 1 - 1 / 240
+
+# Measured cells per item for a partitioned IBLT holding the given number of differing items, split over
+# both sides, to decode with probability at least DECODE_TARGET
+# One row per item count, one column per hash count, regenerate with python param_planner.py
+IBLT_HASH_COUNTS = [3, 4, 5, 6]
+IBLT_TABLE = [
+    (1, [3.000, 4.000, 5.000, 6.000]),
+    (2, [10.000, 8.000, 7.500, 8.000]),
+    (3, [9.000, 7.000, 6.333, 6.333]),
+    (4, [8.750, 6.250, 5.500, 5.250]),
+    (5, [8.000, 6.000, 5.000, 4.400]),
+    (6, [7.833, 5.167, 4.167, 4.167]),
+    (8, [7.375, 4.500, 4.000, 3.375]),
+    (10, [6.200, 4.100, 3.300, 3.000]),
+    (15, [6.200, 3.333, 2.667, 2.533]),
+    (20, [5.100, 2.950, 2.400, 2.300]),
+    (30, [5.333, 2.800, 2.000, 2.133]),
+    (50, [4.160, 1.780, 1.820, 1.960]),
+    (75, [3.800, 1.587, 1.733, 1.853]),
+    (100, [3.650, 1.590, 1.670, 1.840]),
+    (200, [1.825, 1.440, 1.570, 1.755]),
+    (500, [2.588, 1.390, 1.532, 1.690]),
+    (1000, [1.964, 1.367, 1.495, 1.632]),
+]
+IBLT_ITEM_COUNTS = np.array([row[0] for row in IBLT_TABLE], dtype=np.float64)
+IBLT_OVERHEADS = np.array([row[1] for row in IBLT_TABLE], dtype=np.float64)
+
+FPR_MIN = 0.0001
+FPR_MAX = 0.9999
+N_CANDIDATES = 256
+
+def iblt_cells(items):
+    # Cells needed for each item count (rows) and hash count (columns)
+    items = np.maximum(np.asarray(items, dtype=np.float64), 1)
+    overheads = np.stack([np.interp(items, IBLT_ITEM_COUNTS, IBLT_OVERHEADS[:, i])
+                          for i in range(len(IBLT_HASH_COUNTS))], axis=-1)
+    return np.ceil(overheads * items[..., None])
+
+def bloom_size(n_items, fpr):
+    # Bytes of a Bloom filter over n_items at a false positive rate
+    return np.ceil(-n_items * np.log(fpr) / np.log(2)**2 / 8)
+
+def plan(n_set, n_excess, n_missing, cell_size, tail=3):
+    # Bloom false positive rate, IBLT cell count and hash count minimising the bytes sent
+    # n_set: items in the sender's filter, n_excess: receiver items not in the set, n_missing: set items the receiver lacks
+    # cell_size: bytes per IBLT cell, tail: standard deviations of margin on the number of items to recover
+    n_excess = max(n_excess, 0)
+    n_missing = max(n_missing, 0)
+
+    # Candidate numbers of receiver items wrongly passing the filter, geometrically spaced
+    if n_excess >= 1:
+        passing = np.unique(np.geomspace(n_excess * FPR_MIN, n_excess * FPR_MAX, N_CANDIDATES))
+        fprs = passing / n_excess
+    else:
+        passing = np.zeros(1)
+        fprs = np.full(1, FPR_MAX)
+
+    # Items to recover, with a margin as both counts vary around their means
+    items = n_missing + passing
+    items = items + tail * np.sqrt(items)
+
+    cells = iblt_cells(items)
+    bloom_bytes = bloom_size(n_set, fprs) if n_excess >= 1 else np.zeros(1)
+    total = bloom_bytes[:, None] + cell_size * cells
+
+    i, j = np.unravel_index(np.argmin(total), total.shape)
+    return float(fprs[i]), int(cells[i, j]), IBLT_HASH_COUNTS[j]
+
+def plan_block(n_block, n_pool, est_missing_tx_perc, key_size, key_sum_size=4):
+    # Transaction phase, the receiver's pool holds n_pool transactions
+    n_missing = n_block * est_missing_tx_perc
+    n_excess = n_pool - (n_block - n_missing)
+    return plan(n_block, n_excess, n_missing, 1 + key_size + key_sum_size)
+
+def plan_order(n_top_nodes, est_missing_pair_perc, key_size, key_sum_size=4):
+    # Order phase at one height, the receiver's pairs differ from the sender's in est_missing_pair_perc of pairs
+    n_pairs = n_top_nodes // 2
+    n_wrong = n_pairs * est_missing_pair_perc
+    return plan(n_pairs, n_wrong, n_wrong, 1 + key_size + key_sum_size)
+
+def measure_overheads(item_counts, hash_counts, trial_items=5 * 10**4, min_trials=240, key_size=8, seed=0):
+    # Smallest cells per item at which an IBLT over random keys decodes in at least DECODE_TARGET of trials
+    # Small tables fail rarely but cheaply, so they get more trials, up to trial_items keys per cell count tried
+    # Cell counts are then made non decreasing in the item count to smooth out measurement noise
+    from iblt_slim import ArraySIBLT
+    import random
+    rng = random.Random(seed)
+
+    def decodes(n_items, n_cells, n_hashes):
+        # Items are split between both sides of the difference, as keys missing on either side are in practice
+        n_trials = max(min_trials, trial_items // n_items)
+        max_failures = int(n_trials * (1 - DECODE_TARGET))
+        failures = 0
+        for trial in range(n_trials):
+            iblt = ArraySIBLT(n_cells, key_size, 4, n_hashes, partitioned=True)
+            iblt.encode([rng.getrandbits(8 * key_size).to_bytes(key_size, 'little') for i in range(n_items // 2)])
+            other = ArraySIBLT(n_cells, key_size, 4, n_hashes, partitioned=True)
+            other.encode([rng.getrandbits(8 * key_size).to_bytes(key_size, 'little') for i in range(n_items - n_items // 2)])
+            iblt.subtract(other)
+            if iblt.decode()[0] != 'Success':
+                failures += 1
+                if failures > max_failures:
+                    return False
+        return True
+
+    table = []
+    for n_items in item_counts:
+        row = []
+        for n_hashes in hash_counts:
+            # Binary search on the cell count
+            lo, hi = n_hashes, 8 * n_items + 4 * n_hashes
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if decodes(n_items, mid, n_hashes):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            row.append(lo)
+        table.append(row)
+
+    cells = np.maximum.accumulate(np.array(table, dtype=np.float64), axis=0)
+    overheads = cells / np.array(item_counts, dtype=np.float64)[:, None]
+    for n_items, row in zip(item_counts, overheads):
+        print('    (%d, [%s]),' % (n_items, ', '.join('%.3f' % x for x in row)))
+    return overheads
+
+if __name__ == '__main__':
+    measure_overheads([1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 75, 100, 200, 500, 1000], [3, 4, 5, 6])
@@ -0,0 +1,188 @@
+import random
+
+# Protoblock held as a treap ordered by position in the block
+# Each node knows its parent and the size of its subtree, an ID -> node dict finds the node of any
+# transaction, so inserting before an ID, removing an ID and finding the rank of an ID are O(log n) expected
+
+class ProtoBlockNode:
+    __slots__ = ['tx_id', 'priority', 'size', 'left', 'right', 'parent']
+
+    def __init__(self, tx_id, priority):
+        self.tx_id = tx_id
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+def size(node):
+    return node.size if node is not None else 0
+
+class ProtoBlock:
+    def __init__(self, tx_ids=(), seed=None):
+        self.rng = random.Random(seed)
+        self.nodes = {}
+        self.root = None
+        self.build(tx_ids)
+
+    def build(self, tx_ids):
+        # Cartesian tree over the IDs in order, built in O(n) along the right spine
+        spine = []
+        for tx_id in tx_ids:
+            node = self.new_node(tx_id)
+            last = None
+            while spine and spine[-1].priority < node.priority:
+                last = spine.pop()
+            node.left = last
+            if last is not None:
+                last.parent = node
+            if spine:
+                spine[-1].right = node
+                node.parent = spine[-1]
+            spine.append(node)
+        self.root = spine[0] if spine else None
+
+        # Subtree sizes, children before parents
+        order = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(child for child in (node.left, node.right) if child is not None)
+        for node in reversed(order):
+            node.size = 1 + size(node.left) + size(node.right)
+
+    def new_node(self, tx_id):
+        assert tx_id not in self.nodes, 'Transaction already in protoblock'
+        node = ProtoBlockNode(tx_id, self.rng.random())
+        self.nodes[tx_id] = node
+        return node
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, tx_id):
+        return tx_id in self.nodes
+
+    def __iter__(self):
+        # In order walk, yields the transaction IDs in block order
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.tx_id
+            node = node.right
+
+    def to_list(self):
+        return list(self)
+
+    def index(self, tx_id):
+        # Rank of the transaction in the block
+        node = self.nodes[tx_id]
+        rank = size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                rank += size(node.parent.left) + 1
+            node = node.parent
+        return rank
+
+    def __getitem__(self, rank):
+        # Transaction ID at a rank in the block
+        if rank < 0:
+            rank += len(self)
+        if not 0 <= rank < len(self):
+            raise IndexError('Protoblock index out of range')
+        node = self.root
+        while True:
+            left = size(node.left)
+            if rank < left:
+                node = node.left
+            elif rank == left:
+                return node.tx_id
+            else:
+                rank -= left + 1
+                node = node.right
+
+    def append(self, tx_id):
+        node = self.new_node(tx_id)
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while parent.right is not None:
+            parent = parent.right
+        parent.right = node
+        self.attach(node, parent)
+
+    def insert_before(self, tx_id, next_id):
+        # Insert a transaction directly before another already in the block
+        next_node = self.nodes[next_id]
+        node = self.new_node(tx_id)
+        if next_node.left is None:
+            next_node.left = node
+            parent = next_node
+        else:
+            parent = next_node.left
+            while parent.right is not None:
+                parent = parent.right
+            parent.right = node
+        self.attach(node, parent)
+
+    def attach(self, node, parent):
+        # Hang a new leaf below parent, then restore the heap order on priorities
+        node.parent = parent
+        ancestor = parent
+        while ancestor is not None:
+            ancestor.size += 1
+            ancestor = ancestor.parent
+        while node.parent is not None and node.priority > node.parent.priority:
+            self.rotate_up(node)
+
+    def remove(self, tx_id):
+        node = self.nodes.pop(tx_id)
+
+        # Rotate the node down until it has at most one child, then splice it out
+        while node.left is not None and node.right is not None:
+            if node.left.priority > node.right.priority:
+                self.rotate_up(node.left)
+            else:
+                self.rotate_up(node.right)
+        child = node.left if node.left is not None else node.right
+        parent = node.parent
+        self.replace_child(parent, node, child)
+        if child is not None:
+            child.parent = parent
+
+        while parent is not None:
+            parent.size -= 1
+            parent = parent.parent
+
+    def rotate_up(self, node):
+        parent = node.parent
+        if node is parent.left:
+            parent.left = node.right
+            if node.right is not None:
+                node.right.parent = parent
+            node.right = parent
+        else:
+            parent.right = node.left
+            if node.left is not None:
+                node.left.parent = parent
+            node.left = parent
+        self.replace_child(parent.parent, parent, node)
+        node.parent = parent.parent
+        parent.parent = node
+
+        parent.size = 1 + size(parent.left) + size(parent.right)
+        node.size = 1 + size(node.left) + size(node.right)
+
+    def replace_child(self, parent, old, new):
+        if parent is None:
+            self.root = new
+        elif parent.left is old:
+            parent.left = new
+        else:
+            parent.right = new
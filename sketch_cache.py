@@ -0,0 +1,55 @@
+import math
+from collections import OrderedDict
+
+# Sender side cache of encoded GLBLK, GLBLKORD and GLBLKEXT payloads
+# Relaying one block to many peers builds the same sketches again and again, the sketches only
+# depend on the block, the estimated missing percentages and, for GLBLK, the receivers mempool size m.
+# Receivers are grouped into geometric buckets of m, all peers in a bucket get the sketches built
+# for the bucket's upper edge, which errs towards larger filters.
+
+class SketchCache:
+    def __init__(self, max_bytes=64 * 2**20, bucket_width=0.05):
+        self.max_bytes = max_bytes
+        self.bucket_width = bucket_width
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+
+        # Analytics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def bucket(self, m):
+        # Return the bucket index of a mempool size and the size sketches for the bucket are built for
+        b = math.ceil(math.log(max(m, 1)) / math.log(1 + self.bucket_width))
+        while math.ceil((1 + self.bucket_width) ** b) < m:
+            b += 1
+        return b, math.ceil((1 + self.bucket_width) ** b)
+
+    def get(self, key, build):
+        # Return the cached payload fields for key, building and caching them on a miss
+        fields = self.entries.get(key)
+        if fields is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return fields
+
+        self.misses += 1
+        fields = build()
+        size = sum(len(field) for field in fields)
+        if size <= self.max_bytes:
+            self.entries[key] = fields
+            self.n_bytes += size
+            self.evict()
+        return fields
+
+    def evict(self):
+        # Drop least recently used payloads until within budget
+        while self.n_bytes > self.max_bytes:
+            key, fields = self.entries.popitem(last=False)
+            self.n_bytes -= sum(len(field) for field in fields)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.n_bytes}
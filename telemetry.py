@@ -0,0 +1,51 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Per node record of where a relay spends its time and bytes
+# Each protocol phase is timed in wall and CPU time and kept as a record, records are also written as
+# JSON lines if a path is given. snapshot() aggregates the records, it is what travels in COMPLETE
+# Only the latest max_records are held in memory
+
+class Telemetry:
+    def __init__(self, path=None, max_records=10**5):
+        self.path = path
+        self.records = deque(maxlen=max_records)
+
+    def record(self, name, **fields):
+        record = {'name': name, 'time': time.time(), **fields}
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    @contextmanager
+    def phase(self, name, **fields):
+        # Time the body, fields set on the yielded dict are added to the record
+        # CPU time is the running thread's, phases in worker threads and the event loop run at the same time
+        # A body awaiting an executor job would be charged for the loop's other work, so such phases go inside the job
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        yield fields
+        fields['wall'] = time.perf_counter() - start_wall
+        fields['cpu'] = time.thread_time() - start_cpu
+        self.record(name, **fields)
+
+    def snapshot(self, since=0):
+        # Totals per phase and the outcome of every IBLT decode, over the records since a time
+        phases = {}
+        decodes = []
+        for record in self.records:
+            if record['time'] < since:
+                continue
+            if 'wall' in record:
+                total = phases.setdefault(record['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+                total['count'] += 1
+                total['wall'] += record['wall']
+                total['cpu'] += record['cpu']
+            if 'outcome' in record:
+                decodes.append({key: record[key] for key in ('sketch', 'height', 'outcome', 'cells', 'peels')
+                                if key in record})
+        return {'phases': phases, 'decodes': decodes}
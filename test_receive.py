@@ -1,6 +1,7 @@
 import blocks_util
 import byte_tools as bt
 from node import Node
+import asyncio
 
 # Initialise Bobs txpool, currently modeled by a block
 # Ordered by arrival at node
@@ -12,6 +13,10 @@ bob_block_tx_ids = [bt.sha256(tx.encode()) for tx in bob_mempool][:block_size]
 
 bob = Node(bob_mempool, bob_block_tx_ids, 'localhost', 100)
 
-bob.init_server()
-bob.open_connection('localhost', 99)
-bob.listen_for_blocks()
\ No newline at end of file
+async def main():
+    await bob.init_server()
+    session = await bob.open_connection('localhost', 99)
+    await bob.listen_for_blocks(session)
+    bob.close_connection()
+
+asyncio.run(main())
\ No newline at end of file
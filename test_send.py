@@ -1,7 +1,7 @@
 import blocks_util
 import byte_tools as bt
 from node import Node
-import time
+import asyncio
 
 # Initialise Alice's txpool, currently modeled by a orphaned block
 # Ordered by arrival at node
@@ -14,11 +14,18 @@ alice_block_tx_ids = [bt.sha256(tx.encode()) for tx in alice_mempool][offset:blo
 
 alice = Node(alice_mempool, alice_block_tx_ids, 'localhost', 99)
 
-alice.init_server()
-alice.open_connection('localhost', 100)
-time.sleep(1)
 # Estimated percentage in the block which of transactions missing from receivers txpool
 est_missing_tx_perc = 0.1
 # Estimated percentage of missing pairs at height 1
 est_missing_pair_perc = 0.001
-alice.send_block(est_missing_tx_perc, est_missing_pair_perc)
\ No newline at end of file
+
+# Number of peers to relay the block to
+n_peers = 1
+
+async def main():
+    await alice.init_server()
+    peers = await alice.server.wait_for_peers(n_peers)
+    await alice.send_block(est_missing_tx_perc, est_missing_pair_perc, peers)
+    alice.close_connection()
+
+asyncio.run(main())
\ No newline at end of file
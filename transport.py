@@ -0,0 +1,243 @@
+import asyncio
+import random
+import selectors
+import socket
+from collections import deque, namedtuple
+
+# Transports carry the byte streams between peers' NodeServers
+# A transport listens and connects, returning listeners and streams with the same small interface:
+#   listener: await accept() -> (stream, addr), close()
+#   stream: await recv_into(view) -> bytes read (0 once the peer has closed), await sendall(data), close()
+# TcpTransport uses real sockets. LoopbackNetwork connects Nodes in one process through in-memory streams
+# delayed by a link profile, and under SimulatedEventLoop those delays pass in simulated time
+
+
+class TcpStream:
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+
+    async def recv_into(self, view):
+        return await asyncio.get_event_loop().sock_recv_into(self.sock, view)
+
+    async def sendall(self, data):
+        await asyncio.get_event_loop().sock_sendall(self.sock, data)
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpListener:
+    def __init__(self, sock):
+        self.sock = sock
+
+    async def accept(self):
+        conn, addr = await asyncio.get_event_loop().sock_accept(self.sock)
+        return TcpStream(conn), addr
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpTransport:
+    async def listen(self, ip, port, backlog=128):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.bind((ip, port))
+        sock.listen(backlog)
+        return TcpListener(sock)
+
+    async def connect(self, ip, port):
+        # Raises OSError if the peer isn't up
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_event_loop().sock_connect(sock, (ip, port))
+        except OSError:
+            sock.close()
+            raise
+        return TcpStream(sock)
+
+
+# One way latency and jitter in seconds, bandwidth in bytes per second (None for unlimited)
+# Jitter adds a uniformly distributed delay of up to jitter seconds, bytes are still delivered in order
+LinkProfile = namedtuple('LinkProfile', ['latency', 'bandwidth', 'jitter'], defaults=[0.0, None, 0.0])
+
+
+class LoopbackStream:
+    # One end of an in-memory connection, data sent is delivered to the peer end after the link's delay
+    # Each direction queues data behind what it is still transmitting, like a link of the given bandwidth
+
+    def __init__(self, profile, rng):
+        self.profile = profile
+        self.rng = rng
+        self.peer = None
+        self.buffer = bytearray()
+        self.readable = asyncio.Event()
+        self.eof = False
+        self.closed = False
+
+        # Simulated times the link is free to transmit and the last delivery to the peer
+        self.link_free = 0.0
+        self.last_delivery = 0.0
+
+        # Data sent and not yet delivered, None for the close
+        # Timers due at the same time may run in any order, so each delivers the oldest
+        self.in_flight = deque()
+
+    def delivery_time(self, n_bytes):
+        now = asyncio.get_event_loop().time()
+        start = max(now, self.link_free)
+        self.link_free = start + (n_bytes / self.profile.bandwidth if self.profile.bandwidth else 0.0)
+        delay = self.profile.latency + (self.rng.uniform(0, self.profile.jitter) if self.profile.jitter else 0.0)
+        self.last_delivery = max(self.link_free + delay, self.last_delivery)
+        return self.last_delivery
+
+    async def recv_into(self, view):
+        while not self.buffer and not self.eof and not self.closed:
+            self.readable.clear()
+            await self.readable.wait()
+        if self.closed:
+            return 0
+        n = min(len(view), len(self.buffer))
+        view[:n] = self.buffer[:n]
+        del self.buffer[:n]
+        return n
+
+    async def sendall(self, data):
+        # Returns once the data is queued on the link, as a socket send returns once the kernel has it
+        # Data sent after the peer has closed is dropped on delivery
+        if self.closed:
+            raise BrokenPipeError('Loopback connection closed')
+        self.in_flight.append(bytes(data))
+        asyncio.get_event_loop().call_at(self.delivery_time(len(data)), self.deliver_next)
+
+    def deliver_next(self):
+        data = self.in_flight.popleft()
+        if data is None:
+            self.peer.deliver_eof()
+        else:
+            self.peer.deliver(data)
+
+    def deliver(self, data):
+        if not self.closed:
+            self.buffer += data
+            self.readable.set()
+
+    def deliver_eof(self):
+        self.eof = True
+        self.readable.set()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.readable.set()
+        # The peer reads what was already sent before it sees the close
+        self.in_flight.append(None)
+        asyncio.get_event_loop().call_at(self.delivery_time(0), self.deliver_next)
+
+
+class LoopbackListener:
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+        self.pending = asyncio.Queue()
+
+    async def accept(self):
+        return await self.pending.get()
+
+    def close(self):
+        self.network.listeners.pop(self.addr, None)
+
+
+class LoopbackNetwork:
+    # In-memory transport shared by the Nodes of one process, every connection has the same link profile
+    # Jitter is drawn from a seeded generator, so under SimulatedEventLoop a relay replays identically
+
+    def __init__(self, profile=LinkProfile(), seed=0):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.listeners = {}
+        self.next_port = 49152
+
+    async def listen(self, ip, port, backlog=128):
+        if (ip, port) in self.listeners:
+            raise OSError('Loopback address %s : %d in use' % (ip, port))
+        listener = LoopbackListener(self, (ip, port))
+        self.listeners[(ip, port)] = listener
+        return listener
+
+    async def connect(self, ip, port):
+        listener = self.listeners.get((ip, port))
+        if listener is None:
+            raise ConnectionRefusedError('Nothing listening on loopback %s : %d' % (ip, port))
+
+        client = LoopbackStream(self.profile, self.rng)
+        server = LoopbackStream(self.profile, self.rng)
+        client.peer, server.peer = server, client
+        listener.pending.put_nowait((server, (ip, self.next_port)))
+        self.next_port += 1
+
+        # The handshake takes a round trip
+        await asyncio.sleep(2 * self.profile.latency)
+        return client
+
+
+class SimulatedSelector(selectors.DefaultSelector):
+    # Instead of waiting for the next timer, jump the loop's clock to it
+    # Real IO is still polled, and waited on if no timer is scheduled or executor jobs are running,
+    # whose results arrive through the loop's self pipe
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout is not None and timeout <= 0:
+            return events
+        if timeout is None or self.loop.executor_jobs:
+            # Nothing is scheduled or a job is running, only real IO can wake the loop
+            return super().select(None)
+        self.loop.simulated_time += timeout
+        return []
+
+
+class SimulatedEventLoop(asyncio.SelectorEventLoop):
+    # Event loop whose clock only moves when every task is waiting, by as much as the next timer needs
+    # Sleeps, timeouts and loopback link delays take no real time, and computation takes no simulated time,
+    # including computation in executors, the clock waits for them
+
+    def __init__(self):
+        self.simulated_time = 0.0
+        self.executor_jobs = 0
+        super().__init__(SimulatedSelector(self))
+
+    def time(self):
+        return self.simulated_time
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_jobs += 1
+
+        def job_done(future):
+            self.executor_jobs -= 1
+        future.add_done_callback(job_done)
+        return future
+
+
+def run_simulated(main):
+    # Run a coroutine to completion on a SimulatedEventLoop, returns its result and the simulated seconds taken
+    loop = SimulatedEventLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main), loop.time()
+    finally:
+        # Cancel what is left, such as servers still accepting
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
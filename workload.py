@@ -0,0 +1,65 @@
+import byte_tools as bt
+import random
+
+# Seeded synthetic mempools and blocks, so relays can be replayed without fetching blocks
+# Transactions arrive in one order at both nodes. The sender's block holds n_block of them in arrival order,
+# apart from reordered runs. The receiver lacks a fraction of the block and
+# holds excess transactions which are not in it
+# Runs are reordered in place, the order phase reconciles local reorderings but not runs moved far away
+
+def random_bytes(rng, n):
+    # Same bytes as rng.randbytes(n), which needs Python 3.9
+    return rng.getrandbits(8 * n).to_bytes(n, 'little')
+
+class Workload:
+    def __init__(self, sender_pool, block_tx_ids, receiver_pool, seed=None):
+        self.sender_pool = sender_pool
+        self.block_tx_ids = block_tx_ids
+        self.receiver_pool = receiver_pool
+        self.seed = seed
+
+    @classmethod
+    def generate(cls, n_block, seed=0, missing=0.01, excess=1.0, reordered_runs=0, run_length=4,
+                 sender_extra=0.1, tx_size=32):
+        # missing: fraction of the block not in the receiver's pool
+        # excess: receiver pool transactions not in the block, as a fraction of the block
+        # reordered_runs: number of runs of run_length consecutive block transactions shuffled in place
+        # sender_extra: sender pool transactions not in the block, as a fraction of the block
+        rng = random.Random(seed)
+        n_sender_extra = int(sender_extra * n_block)
+        n_excess = int(excess * n_block)
+
+        # Arrival order of every transaction, the block and the sender's extra transactions are interleaved
+        txs = [random_bytes(rng, tx_size).hex() for i in range(n_block + max(n_sender_extra, n_excess))]
+        in_block = [True] * n_block + [False] * (len(txs) - n_block)
+        rng.shuffle(in_block)
+        block_txs = [tx for tx, b in zip(txs, in_block) if b]
+        other_txs = [tx for tx, b in zip(txs, in_block) if not b]
+
+        sender_extra_txs = set(other_txs[:n_sender_extra])
+        sender_pool = [tx for tx, b in zip(txs, in_block) if b or tx in sender_extra_txs]
+
+        # The receiver's excess overlaps the sender's extra transactions as far as it can
+        missing_txs = set(rng.sample(block_txs, int(missing * n_block)))
+        excess_txs = set(other_txs[:n_excess])
+        receiver_pool = [tx for tx, b in zip(txs, in_block) if (b and tx not in missing_txs) or tx in excess_txs]
+
+        block_tx_ids = [bt.sha256(tx.encode()) for tx in block_txs]
+        for i in range(reordered_runs):
+            start = rng.randrange(max(1, n_block - run_length))
+            run = block_tx_ids[start:start + run_length]
+            rng.shuffle(run)
+            block_tx_ids[start:start + run_length] = run
+
+        return cls(sender_pool, block_tx_ids, receiver_pool, seed)
+
+    def receiver_guess(self):
+        # Block the receiver starts from, the first transactions of its pool
+        return [bt.sha256(tx.encode()) for tx in self.receiver_pool[:len(self.block_tx_ids)]]
+
+    def nodes(self, ip='localhost', sender_port=0, receiver_port=0, transport=None):
+        # Sender and receiver nodes holding the workload's pools
+        from node import Node
+        sender = Node(self.sender_pool, self.block_tx_ids, ip, sender_port, transport)
+        receiver = Node(self.receiver_pool, self.receiver_guess(), ip, receiver_port, transport)
+        return sender, receiver